@@ -0,0 +1,379 @@
+"""asyncio runtime: polls Telegram, relays chat messages and sends notifications without blocking
+
+Chosen at startup with BOT_RUNTIME=asyncio (see main.py). Polling and all
+async send functions share one HTTP client, aiohttp when it is installed
+or the small built-in HTTP/1.1 client otherwise, so thousands of calls can
+be in flight at once. Messages and edits between matched users are relayed
+natively; every other update runs the regular handlers of get_updates in a
+pool of HANDLER_THREADS threads, whose replies are still sent through the
+event loop and its client. Updates of one chat are always handled in order. Point BASE_URL in
+root.json at a local server to run it against a stand-in for Telegram.
+"""
+import asyncio
+import json
+import os
+import ssl
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+import get_updates
+import match
+import metrics
+import rate_limit
+import root_json
+import send_updates
+from log import log
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None  # The built-in client is used instead
+
+HTTP_POOL_SIZE = 100  # Open connections per host
+HTTP_TIMEOUT = 30  # Seconds for a whole API call
+MAX_IN_FLIGHT = 1000  # Outbound API calls running at once
+FETCH_RETRY_DELAY = 5  # Seconds to wait after a failed getUpdates
+HANDLER_THREADS = int(os.environ.get('ASYNC_HANDLER_THREADS', '32'))  # Threads running the blocking handlers
+
+
+class AsyncHttpClient:
+    """Minimal HTTP/1.1 client on asyncio streams, keeping connections alive per host"""
+
+    def __init__(self, pool_size=HTTP_POOL_SIZE):
+        self.pool_size = pool_size
+        self._idle = {}
+        self._slots = {}
+        self._ssl = ssl.create_default_context()
+
+    async def request(self, method, url, params=None, json_body=None, timeout=HTTP_TIMEOUT):
+        """Send a request, returns (status, body bytes)"""
+        parts = urllib.parse.urlsplit(url)
+        secure = parts.scheme == "https"
+        host = parts.hostname
+        port = parts.port or (443 if secure else 80)
+        query = "&".join(filter(None, [parts.query, urllib.parse.urlencode(params or {})]))
+        path = (parts.path or "/") + (f"?{query}" if query else "")
+        body = json.dumps(json_body).encode() if json_body is not None else b""
+        head = (f"{method} {path} HTTP/1.1\r\nHost: {parts.netloc}\r\nContent-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: keep-alive\r\n\r\n").encode()
+
+        key = (host, port, secure)
+        slots = self._slots.setdefault(key, asyncio.Semaphore(self.pool_size))
+        async with slots:
+            idle = self._idle.setdefault(key, [])
+            # A kept-alive connection may have been closed by the server, retry once on a new one
+            for reused in ([True, False] if idle else [False]):
+                if reused:
+                    reader, writer = idle.pop()
+                else:
+                    reader, writer = await asyncio.wait_for(
+                        asyncio.open_connection(host, port, ssl=self._ssl if secure else None), timeout)
+                try:
+                    writer.write(head + body)
+                    await writer.drain()
+                    status, keep_alive, response = await asyncio.wait_for(self._read_response(reader), timeout)
+                except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+                    writer.close()
+                    if reused:
+                        continue
+                    raise
+                except BaseException:
+                    writer.close()
+                    raise
+                if keep_alive:
+                    idle.append((reader, writer))
+                else:
+                    writer.close()
+                return status, response
+
+    async def _read_response(self, reader):
+        """Read one response, returns (status, keep_alive, body)"""
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError("Connection closed by server")
+        status = int(status_line.split()[1])
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = headers.get("connection", "").lower() != "close"
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            return status, keep_alive, b"".join(chunks)
+        if "content-length" in headers:
+            return status, keep_alive, await reader.readexactly(int(headers["content-length"]))
+        return status, False, await reader.read()
+
+    async def close(self):
+        """Close every kept-alive connection"""
+        for connections in self._idle.values():
+            for reader, writer in connections:
+                writer.close()
+        self._idle.clear()
+
+
+class AiohttpClient:
+    """Same interface as AsyncHttpClient on top of aiohttp"""
+
+    def __init__(self, pool_size=HTTP_POOL_SIZE):
+        self.pool_size = pool_size
+        self._session = None
+
+    async def request(self, method, url, params=None, json_body=None, timeout=HTTP_TIMEOUT):
+        """Send a request, returns (status, body bytes)"""
+        if self._session is None:
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit_per_host=self.pool_size))
+        async with self._session.request(method, url, params=params, json=json_body,
+                                         timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            return response.status, await response.read()
+
+    async def close(self):
+        """Close the session"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+_client = None
+_in_flight = None
+_chat_tails = {}  # chat_id -> task handling the chat's latest update
+_handling = 0  # Updates dispatched and not finished
+
+
+def get_client():
+    """Get the shared HTTP client"""
+    global _client
+    if _client is None:
+        _client = AiohttpClient() if aiohttp is not None else AsyncHttpClient()
+    return _client
+
+
+async def _request(method, data=None, params=None, http_method="POST", timeout=HTTP_TIMEOUT, bulk=False):
+    """Call a Bot API method within the rate limits, retrying 429 and 5xx, returns (status, body)"""
+    global _in_flight
+    if _in_flight is None:
+        _in_flight = asyncio.Semaphore(MAX_IN_FLIGHT)
+    url = f"{root_json.root_read('BASE_URL')}/{method}"
+    chat_id = (data or {}).get("chat_id")
+    for attempt in range(rate_limit.MAX_RETRIES + 1):
+        # getUpdates is a long poll, not a message
+        while method != "getUpdates" and (wait := rate_limit.reserve(chat_id, bulk)):
+            await asyncio.sleep(wait)
+        async with _in_flight:
+            status, body = await get_client().request(http_method, url, params=params, json_body=data, timeout=timeout)
+        if status == 429:
+            delay = rate_limit.retry_after(body)
+            if chat_id is not None:
+                rate_limit.pause(chat_id, delay)
+            elif delay <= rate_limit.MAX_RETRY_WAIT:
+                await asyncio.sleep(delay)
+        elif status >= 500:
+            delay = rate_limit.backoff_delay(attempt)
+            await asyncio.sleep(delay)
+        else:
+            break
+        if attempt == rate_limit.MAX_RETRIES or delay > rate_limit.MAX_RETRY_WAIT:
+            break
+        metrics.increment("telegram_retries")
+    return status, body
+
+
+async def api_call(method, data=None, params=None, http_method="POST", timeout=HTTP_TIMEOUT, bulk=False):
+    """Call a Bot API method within the rate limits, returns the decoded response or None on error"""
+    try:
+        status, body = await _request(method, data, params, http_method, timeout, bulk)
+        if status != 200:
+            log(f"Error calling {method}: {body.decode(errors='replace')}")
+        return json.loads(body) if body else None
+    except Exception as e:
+        log(f"Exception calling {method}: {e}")
+        return None
+
+
+def _thread_sender(loop):
+    """Get a send_updates sender that runs the calls of handler threads on the loop"""
+    loop_thread = threading.get_ident()
+
+    def send(method, data, bulk):
+        if threading.get_ident() == loop_thread:
+            return None  # Waiting on the loop from inside it would block it, call directly
+        return asyncio.run_coroutine_threadsafe(_request(method, data, bulk=bulk), loop).result()
+
+    return send
+
+
+async def send_message(chat_id, text, reply_markup=None, parse_mode=None, bulk=False):
+    """Send message to user, bulk messages wait behind chat relays"""
+    data = {"chat_id": chat_id, "text": text}
+    if reply_markup:
+        data["reply_markup"] = reply_markup
+    if parse_mode:
+        data["parse_mode"] = parse_mode
+    return await api_call("sendMessage", data, bulk=bulk)
+
+
+async def send_messages(messages):
+    """Send a batch of (chat_id, text) or (chat_id, text, reply_markup) messages concurrently, returns how many were delivered"""
+    results = await asyncio.gather(*(send_message(chat_id, text, reply_markup[0] if reply_markup else None, bulk=True)
+                                     for chat_id, text, *reply_markup in messages))
+    return sum(1 for result in results if result and result.get("ok"))
+
+
+async def forward_to_partner(chat_id, partner_id, message, message_type):
+    """Relay a message to the matched partner with the calls get_updates.relay_calls builds"""
+    match.touch_match(chat_id)
+    try:
+        for method, data in get_updates.relay_calls(chat_id, partner_id, message, message_type):
+            await api_call(method, data)
+    except Exception as e:
+        log(f"Error forwarding {message_type} message: {e}")
+        await send_message(chat_id, f"Error sending {message_type} to partner")
+
+
+async def _relay_type(chat_id, message):
+    """Get the type of a message that is a plain relay to the partner, or None"""
+    if 'text' in message:
+        text = message['text']
+        # Commands, OTPs and email entry go through the regular handler
+        if text.startswith("/") or text.startswith("GC-"):
+            return None
+        if await asyncio.to_thread(os.path.exists, f"temp_context_{chat_id}.txt"):
+            return None
+        return 'text'
+    for message_type in ('photo', 'document', 'voice', 'video', 'sticker', 'location'):
+        if message_type in message:
+            return message_type
+    return None
+
+
+async def handle_message(message):
+    """Handle incoming messages, relaying chat messages without a thread"""
+    chat_id = message['from']['id']
+    message_type = await _relay_type(chat_id, message)
+    partner_id = match.check_matched(chat_id) if message_type else None
+    if partner_id is not None:
+        await forward_to_partner(chat_id, partner_id, message, message_type)
+    else:
+        await asyncio.to_thread(get_updates.handle_message, message)
+
+
+async def handle_edited_message(edited_message):
+    """Tell the matched partner about an edited message"""
+    chat_id = edited_message['from']['id']
+    partner_id = match.check_matched(chat_id)
+    if not partner_id:
+        return
+    try:
+        for method, data in get_updates.edit_relay_calls(chat_id, partner_id, edited_message):
+            await api_call(method, data)
+    except Exception as e:
+        log(f"Error forwarding edited message: {e}")
+        await send_message(chat_id, "Error sending edited message to partner")
+
+
+async def callback(text, result):
+    """Handle callback queries"""
+    await asyncio.to_thread(get_updates.callback, text, result)
+
+
+async def commands(text, chat_id):
+    """Handle bot commands"""
+    await asyncio.to_thread(get_updates.commands, text, chat_id)
+
+
+async def process_update(result):
+    """Dispatch a single update to its handler"""
+    message = result.get('message')
+    if message:
+        await handle_message(message)
+
+    edited_message = result.get('edited_message')
+    if edited_message:
+        await handle_edited_message(edited_message)
+
+    elif 'callback_query' in result:
+        cb = result['callback_query']
+        await callback(text=cb['data'], result=cb)
+
+
+async def _handle_after(previous, result, slots):
+    """Handle an update once the previous update of its chat is done"""
+    global _handling
+    try:
+        if previous is not None:
+            await asyncio.wait([previous])
+        update_id = result.get('update_id')
+        if update_id is not None and get_updates.already_processed(update_id):
+            log(f"Skipping already processed update {update_id}")
+        else:
+            try:
+                await process_update(result)
+            except Exception as e:
+                log(f"Error processing update: {e}")
+        if update_id is not None:
+            get_updates.mark_processed(update_id)
+    finally:
+        _handling -= 1
+        slots.release()
+
+
+def _dispatch(result, slots):
+    """Start handling an update, chained behind its chat's earlier updates"""
+    global _handling
+    _handling += 1
+    chat_id = get_updates.update_chat_id(result)
+    if result.get('update_id') is not None:
+        get_updates.mark_dispatched(result['update_id'])
+    task = asyncio.get_running_loop().create_task(_handle_after(_chat_tails.get(chat_id), result, slots))
+    _chat_tails[chat_id] = task
+    task.add_done_callback(lambda done: _chat_tails.pop(chat_id, None) if _chat_tails.get(chat_id) is done else None)
+
+
+async def run(TIMEOUT):
+    """Long-poll and handle updates until cancelled"""
+    # At most UPDATE_QUEUE_SIZE updates are being handled; polling waits for room
+    slots = asyncio.Semaphore(get_updates.UPDATE_QUEUE_SIZE)
+    offset = get_updates._load_checkpoint()
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(HANDLER_THREADS, thread_name_prefix="update-handler"))
+    send_updates.set_async_sender(_thread_sender(loop))
+    log(f"asyncio runtime started with {'aiohttp' if aiohttp is not None else 'the built-in HTTP client'}")
+    try:
+        # Updates received but not handled before the last stop come first
+        for result in get_updates.replay_spool():
+            await slots.acquire()
+            _dispatch(result, slots)
+            offset = max(offset, result['update_id'] + 1)
+
+        while True:
+            limit = max(1, min(get_updates.MAX_UPDATES_PER_FETCH, get_updates.UPDATE_QUEUE_SIZE - _handling))
+            response = await api_call("getUpdates", params={"offset": offset, "timeout": TIMEOUT, "limit": limit},
+                                      http_method="GET", timeout=TIMEOUT + 5)
+            if response is None or not response.get("ok"):
+                await asyncio.sleep(FETCH_RETRY_DELAY)
+                continue
+
+            # On disk before the next getUpdates acknowledges them
+            await asyncio.to_thread(get_updates.spool_updates, response.get("result", []))
+            for result in response.get("result", []):
+                await slots.acquire()
+                _dispatch(result, slots)
+                if result.get('update_id') is not None:
+                    offset = max(offset, result['update_id'] + 1)
+            get_updates.commit_offset()
+    finally:
+        send_updates.set_async_sender(None)
+        get_updates.commit_offset()
+        await get_client().close()
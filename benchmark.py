@@ -0,0 +1,235 @@
+"""Matching benchmark: builds synthetic lobbies and times matching rounds
+
+Runs entirely in memory: storage uses the memory backend, message sending and
+log are replaced with counters, and the match change log goes to a
+temporary file. Usage:
+
+    python3 benchmark.py --sizes 100 1000 10000 100000 --rounds 3
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+import storage
+import user_json
+import lobby
+import lobby_index
+import match_registry
+import match
+import match_shards
+import recent_pairs
+import referral
+
+# Matching engines that can be compared
+ENGINES = list(match.ENGINES)
+
+DEFAULT_SIZES = [100, 1000, 10000, 100000]
+
+sent_messages = 0
+
+
+def _count_message(chat_id, text, reply_markup=None, parse_mode=None):
+    """Stand-in for send_updates.send_message"""
+    global sent_messages
+    sent_messages += 1
+
+
+def _count_messages(messages):
+    """Stand-in for send_updates.send_messages"""
+    global sent_messages
+    messages = list(messages)
+    sent_messages += len(messages)
+    return len(messages)
+
+
+def _quiet_log(text):
+    """Stand-in for log.log"""
+    pass
+
+
+def install_stand_ins():
+    """Point every module at in-memory storage and silent I/O"""
+    for module in (match, lobby, lobby_index, match_registry, user_json, referral, storage):
+        module.log = _quiet_log
+    match.send_messages = _count_messages
+    lobby.send_message = _count_message
+    referral.send_message = _count_message
+    match_registry.log_filepath = os.path.join(tempfile.mkdtemp(prefix="ghostchat-bench-"), "matches.log")
+    storage._backend = storage.MemoryBackend()
+
+
+def parse_mix(text):
+    """Parse 'Any:0.6,Male:0.2,Female:0.2' into a weights dict"""
+    weights = {}
+    for part in text.split(","):
+        name, weight = part.split(":")
+        weights[name.strip()] = float(weight)
+    return weights
+
+
+def build_lobby(size, male_ratio, prefer_mix, vip_ratio, org_ratio, domains, max_wait, rng):
+    """Create size synthetic users, put them all in the lobby and reload module state"""
+    now = time.time()
+    expiry = (datetime.now() + timedelta(days=30)).strftime("%Y-%m-%d %H:%M:%S")
+    prefer_names = list(prefer_mix)
+    prefer_weights = [prefer_mix[name] for name in prefer_names]
+    domain_names = [f"org{number}.edu" for number in range(domains)]
+
+    users = {}
+    entries = {}
+    memberships = {}
+    for number in range(size):
+        chat_id = str(1000000 + number)
+        gender = "Male" if rng.random() < male_ratio else "Female"
+        prefer = rng.choices(prefer_names, prefer_weights)[0]
+        user_type = "VIP" if rng.random() < vip_ratio else "Free"
+        match_org = bool(domain_names) and rng.random() < org_ratio
+        domain = rng.choice(domain_names) if match_org else "gmail.com"
+
+        users[chat_id] = {
+            "first_name": "Bench",
+            "last_name": str(number),
+            "username": "",
+            "gender": gender,
+            "prefer": prefer,
+            "type": user_type,
+            "email": f"user{number}@{domain}",
+            "match_org": match_org
+        }
+        entries[chat_id] = {
+            "gender": gender,
+            "prefer": prefer,
+            "type": user_type,
+            "match_org": match_org,
+            "domain": domain,
+            "joined_at": now - rng.uniform(0, max_wait)
+        }
+        if user_type == "VIP":
+            memberships[chat_id] = {"type": "VIP", "expiry_date": expiry}
+
+    backend = storage.get_backend()
+    backend.replace_all("users", users)
+    backend.replace_all("lobby", entries)
+    backend.replace_all("memberships", memberships)
+    backend.replace_all("matches", {})
+
+    # Keep every wait time of the round, not just the most recent ones
+    lobby_index.WAIT_SAMPLES = max(lobby_index.WAIT_SAMPLES, size)
+
+    # Drop cached module state so everything reloads from the memory backend
+    user_json._users = None
+    user_json._dirty.clear()
+    lobby._queue = None
+    recent_pairs._filter = None
+    match_registry._partners = None
+    match_registry._activity.clear()
+    match_registry._log_entries = 0
+    if match_registry._log_file is not None:
+        match_registry._log_file.close()
+        match_registry._log_file = None
+    if os.path.exists(match_registry.log_filepath):
+        os.remove(match_registry.log_filepath)
+
+    user_json.user_read_untagged()
+    lobby.get_queue()
+
+
+def run_scenario(engine, size, rounds, options, seed):
+    """Time `rounds` matching rounds on fresh lobbies of `size` users"""
+    global sent_messages
+    rng = random.Random(seed)
+    total_time = 0.0
+    total_pairs = 0
+    leftovers = []
+    waits = []
+
+    for _ in range(rounds):
+        build_lobby(size, rng=rng, **options)
+        sent_messages = 0
+
+        match.set_engine(engine)
+        start = time.perf_counter()
+        match.get_matched()
+        total_time += time.perf_counter() - start
+
+        total_pairs += match_registry.count_matches()
+        leftovers.append(lobby.tot_lobby())
+        waits.extend(wait for _, wait in lobby.get_queue().waits)
+
+    return {
+        "engine": engine,
+        "size": size,
+        "rounds_per_sec": rounds / total_time if total_time else 0.0,
+        "pairs_per_sec": total_pairs / total_time if total_time else 0.0,
+        "pairs_per_round": total_pairs / rounds,
+        "unmatched": sum(leftovers) / rounds,
+        "wait": lobby_index.percentiles(waits)
+    }
+
+
+def print_results(results):
+    """Print benchmark results as a table"""
+    header = f"{'engine':<10}{'users':>8}{'rounds/s':>11}{'pairs/s':>12}{'pairs':>9}{'unmatched':>11}{'wait p50':>10}{'p90':>8}{'p99':>8}"
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        wait = result["wait"]
+        print(f"{result['engine']:<10}{result['size']:>8}{result['rounds_per_sec']:>11.2f}"
+              f"{result['pairs_per_sec']:>12.0f}{result['pairs_per_round']:>9.0f}{result['unmatched']:>11.0f}"
+              f"{wait['p50']:>10.0f}{wait['p90']:>8.0f}{wait['p99']:>8.0f}")
+
+
+def print_crossover(results, baseline="greedy"):
+    """Print the lobby size from which each engine stays faster than the baseline"""
+    speeds = {(result["engine"], result["size"]): result["rounds_per_sec"] for result in results}
+    for engine in sorted({result["engine"] for result in results} - {baseline}):
+        sizes = sorted(size for name, size in speeds if name == engine and (baseline, size) in speeds)
+        crossover = None
+        for size in reversed(sizes):
+            if speeds[(engine, size)] <= speeds[(baseline, size)]:
+                break
+            crossover = size
+        if crossover is None:
+            print(f"{engine}: not faster than {baseline} at the largest size run")
+        else:
+            print(f"{engine}: faster than {baseline} from {crossover} users")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark GhostChat matching engines on synthetic lobbies")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Lobby sizes to run")
+    parser.add_argument("--rounds", type=int, default=3, help="Rounds per size, each on a fresh lobby")
+    parser.add_argument("--engines", nargs="+", default=ENGINES, choices=ENGINES, help="Engines to compare")
+    parser.add_argument("--male-ratio", type=float, default=0.6, help="Share of male users")
+    parser.add_argument("--prefer-mix", default="Any:0.5,Male:0.2,Female:0.3", help="Gender preference weights")
+    parser.add_argument("--vip-ratio", type=float, default=0.1, help="Share of VIP users")
+    parser.add_argument("--org-ratio", type=float, default=0.2, help="Share of users matching within their organisation")
+    parser.add_argument("--domains", type=int, default=20, help="Number of organisation email domains")
+    parser.add_argument("--max-wait", type=float, default=900, help="Users joined up to this many seconds ago")
+    parser.add_argument("--workers", type=int, default=0, help="Matching worker processes, 0 pairs in-process")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed")
+    args = parser.parse_args()
+
+    options = {
+        "male_ratio": args.male_ratio,
+        "prefer_mix": parse_mix(args.prefer_mix),
+        "vip_ratio": args.vip_ratio,
+        "org_ratio": args.org_ratio,
+        "domains": args.domains,
+        "max_wait": args.max_wait
+    }
+
+    install_stand_ins()
+    match_shards.MATCH_WORKERS = args.workers
+    results = []
+    for size in args.sizes:
+        for engine in args.engines:
+            results.append(run_scenario(engine, size, args.rounds, options, args.seed))
+    print_results(results)
+    print_crossover(results)
+
+
+if __name__ == "__main__":
+    main()
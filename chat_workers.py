@@ -0,0 +1,69 @@
+import queue
+import threading
+import zlib
+from log import log
+
+
+class ChatWorkerPool:
+    """Worker threads that run items keyed by chat id
+
+    Every chat is hashed to one worker, so the items of a chat run strictly
+    in submission order while different chats run concurrently. Each worker
+    has a bounded queue; submit() blocks while the chat's worker queue is full.
+    """
+
+    def __init__(self, handler, workers, queue_depth, name="chat-worker"):
+        self.handler = handler
+        self.queues = [queue.Queue(maxsize=queue_depth) for _ in range(workers)]
+        self._pending = {}  # chat_id -> items queued or running
+        self._lock = threading.Lock()
+        self.threads = []
+        for number, work_queue in enumerate(self.queues):
+            thread = threading.Thread(target=self._run, args=(work_queue,), name=f"{name}-{number}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _queue_for(self, chat_id):
+        return self.queues[zlib.crc32(str(chat_id).encode()) % len(self.queues)]
+
+    def submit(self, chat_id, item):
+        """Queue an item to run after the chat's earlier items"""
+        chat_id = str(chat_id)
+        with self._lock:
+            self._pending[chat_id] = self._pending.get(chat_id, 0) + 1
+        self._queue_for(chat_id).put((chat_id, item))
+
+    def _run(self, work_queue):
+        while True:
+            chat_id, item = work_queue.get()
+            try:
+                self.handler(item)
+            except Exception as e:
+                log(f"Error in chat worker for chat_id {chat_id}: {e}")
+            finally:
+                with self._lock:
+                    remaining = self._pending.get(chat_id, 1) - 1
+                    if remaining:
+                        self._pending[chat_id] = remaining
+                    else:
+                        self._pending.pop(chat_id, None)
+                work_queue.task_done()
+
+    def pending(self, chat_id):
+        """Get the number of a chat's items queued or running"""
+        with self._lock:
+            return self._pending.get(str(chat_id), 0)
+
+    def pending_counts(self):
+        """Get {chat_id: items queued or running} for every chat with work"""
+        with self._lock:
+            return dict(self._pending)
+
+    def queue_lengths(self):
+        """Get the number of items queued on each worker"""
+        return [work_queue.qsize() for work_queue in self.queues]
+
+    def join(self):
+        """Wait until every submitted item has run"""
+        for work_queue in self.queues:
+            work_queue.join()
@@ -0,0 +1,148 @@
+"""Pairing engine checks: compares the engines on random lobbies
+
+Every engine must give valid pairs (compatible, each user at most once, no
+recent partners), and the maximum engine as many pairs as a brute-force
+search on small lobbies, leaving the same lowest-priority users unpaired.
+Exits with status 1 if a check fails. Usage:
+
+    python3 check_engines.py --lobbies 300 --seed 1
+"""
+import argparse
+import random
+import sys
+import time
+from functools import lru_cache
+from lobby_index import bucket_key, keys_compatible, greedy_pairs
+from lobby_maximum import maximum_pairs
+from recent_pairs import RecentPairs
+
+GENDERS = ["Male", "Female"]
+PREFERENCES = ["Any", "Male", "Female"]
+DOMAINS = ["org0.edu", "org1.edu"]
+
+
+def random_lobby(size, rng):
+    """Build a lobby in matching order from random users"""
+    now = time.time()
+    users = []
+    for number in range(size):
+        match_org = rng.random() < 0.3
+        entry = {
+            "gender": rng.choice(GENDERS),
+            "prefer": rng.choice(PREFERENCES),
+            "type": "VIP" if rng.random() < 0.2 else "Free",
+            "match_org": match_org,
+            "domain": rng.choice(DOMAINS) if match_org else "gmail.com",
+            "joined_at": now - rng.uniform(0, 900)
+        }
+        users.append((str(1000 + number), entry, size - number))
+    return users
+
+
+def random_recent(users, rng):
+    """Mark a few random pairs of the lobby as recently paired"""
+    recent = RecentPairs(capacity=1000)
+    for _ in range(rng.randint(0, len(users))):
+        user1, user2 = rng.sample(users, 2)
+        recent.add(user1[0], user2[0])
+    return recent
+
+
+def pair_problems(users, pairs, recent):
+    """Get a description of what is wrong with the pairs, or None"""
+    seen = set()
+    for first, second in pairs:
+        if first in seen or second in seen or first == second:
+            return f"position paired twice in {pairs}"
+        seen.update((first, second))
+        (user1_id, entry1, _), (user2_id, entry2, _) = users[first], users[second]
+        key1, key2 = bucket_key(user1_id, entry1), bucket_key(user2_id, entry2)
+        if key1 is None or key2 is None or not keys_compatible(key1, key2):
+            return f"incompatible pair {user1_id} <-> {user2_id}"
+        if recent.contains(user1_id, user2_id):
+            return f"recent partners paired {user1_id} <-> {user2_id}"
+    return None
+
+
+def check_greedy(lobbies, rng):
+    """The greedy engine must give valid pairs"""
+    for number in range(lobbies):
+        users = random_lobby(rng.randint(2, 60), rng)
+        recent = random_recent(users, rng)
+        problem = pair_problems(users, greedy_pairs(users, recent=recent), recent)
+        if problem:
+            return f"greedy lobby {number}: {problem}"
+    return None
+
+
+def brute_force_best(users):
+    """Get (pairs, sum of unpaired positions) of the best maximum matching by trying every pairing
+
+    Among maximum matchings the best leaves the lowest-priority users
+    unpaired, i.e. has the largest sum of unpaired positions. For small
+    lobbies only.
+    """
+    keys = [bucket_key(user_id, entry) for user_id, entry, _ in users]
+
+    def allowed(first, second):
+        return keys[first] is not None and keys[second] is not None and keys_compatible(keys[first], keys[second])
+
+    @lru_cache(maxsize=None)
+    def best(unmatched):
+        if not unmatched:
+            return (0, 0)
+        first, rest = unmatched[0], unmatched[1:]
+        pairs, unpaired = best(rest)
+        result = (pairs, unpaired + first)
+        for second in rest:
+            if allowed(first, second):
+                pairs, unpaired = best(tuple(other for other in rest if other != second))
+                result = max(result, (pairs + 1, unpaired))
+        return result
+
+    return best(tuple(range(len(users))))
+
+
+def check_maximum(lobbies, rng):
+    """The maximum engine must pair as many users as brute force, the same ones by priority, and respect recent partners"""
+    for number in range(lobbies):
+        users = random_lobby(rng.randint(2, 12), rng)
+        # Budget large enough that the engine never falls back to greedy
+        pairs = maximum_pairs(users, budget=60)
+        expected_pairs, expected_unpaired = brute_force_best(users)
+        if len(pairs) != expected_pairs:
+            return f"maximum lobby {number}: {len(pairs)} pairs, brute force finds {expected_pairs}"
+        paired = {position for pair in pairs for position in pair}
+        unpaired = sum(position for position in range(len(users)) if position not in paired)
+        if unpaired != expected_unpaired:
+            return f"maximum lobby {number}: leaves higher-priority users unpaired than brute force"
+        problem = pair_problems(users, pairs, RecentPairs(capacity=1000))
+        if problem:
+            return f"maximum lobby {number}: {problem}"
+
+        recent = random_recent(users, rng)
+        problem = pair_problems(users, maximum_pairs(users, budget=60, recent=recent), recent)
+        if problem:
+            return f"maximum lobby {number} with recent partners: {problem}"
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the pairing engines on random lobbies")
+    parser.add_argument("--lobbies", type=int, default=300, help="random lobbies per check")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    checks = [("greedy is valid", check_greedy), ("maximum is optimal", check_maximum)]
+
+    failed = False
+    for name, check in checks:
+        problem = check(args.lobbies, rng)
+        print(f"{name}: {'FAILED - ' + problem if problem else 'ok'}")
+        failed = failed or problem is not None
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
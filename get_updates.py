@@ -1,53 +1,349 @@
 import json
 import requests
 import os
+import queue
+import threading
+import time
+from collections import deque
 import email_verification
+import http_client
+from chat_workers import ChatWorkerPool
 import lobby
 import root_json
 from log import log
-from send_updates import send_message, send_photo, send_document, send_voice, get_file, download_file, copy_message
+from send_updates import send_message, call_method, get_file, download_file
 import user_json
 from lobby import add_to_lobby
 import match
+import metrics
 from referral import add_referral, create_referral_link, get_user_referrals
 
-def read_msg(TIMEOUT):
-    BASE_URL = root_json.root_read("BASE_URL")
-    offset = root_json.root_read("offset")
+CHECKPOINT_EVERY = 50  # Commit the offset at least every N processed updates
+CHECKPOINT_INTERVAL = 2.0  # ...or every T seconds, whichever comes first
+PROCESSED_RING_SIZE = 1000  # Recently processed update ids kept for replay protection
+UPDATE_QUEUE_SIZE = 500  # Fetched updates waiting to be handled; the fetcher stops when it is full
+MAX_UPDATES_PER_FETCH = 100  # Telegram's getUpdates limit
+FETCH_RETRY_DELAY = 5  # Seconds to wait after a failed getUpdates
+UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', '8'))  # Handler threads, 0 handles updates in the polling thread
+UPDATE_WORKER_QUEUE = int(os.environ.get('UPDATE_WORKER_QUEUE', '100'))  # Updates queued per handler thread
+
+# Update ids processed since the last checkpoint, appended as they complete
+journal_filepath = os.path.join(os.path.dirname(__file__), "Json Files", "processed_updates.log")
+# Updates received but not handled yet, one JSON per line, written before Telegram considers them delivered
+spool_filepath = os.path.join(os.path.dirname(__file__), "Json Files", "received_updates.log")
+
+_offset = None
+_pending_updates = 0
+_last_checkpoint = time.monotonic()
+_processed_ids = deque(maxlen=PROCESSED_RING_SIZE)
+_processed_set = set()
+_journal = None
+_checkpoint_lock = threading.RLock()
+# Update ids handed to the workers and not finished; the offset never passes the lowest
+_in_flight = set()
+_max_finished = None  # Highest update id handled so far
+_finished_ahead = set()  # Handled update ids at or above the offset, kept in the journal at checkpoints
+_spooled = {}  # update_id -> update received and not yet below the committed offset
+_spool = None
+
+# Updates fetched by the fetcher thread and not handled yet
+_updates = queue.Queue(maxsize=UPDATE_QUEUE_SIZE)
+_fetcher = None
+_workers = None
+
+def _load_checkpoint():
+    """Load the committed offset and replay the processed-update journal"""
+    global _offset, _journal, _max_finished
+    with _checkpoint_lock:
+        if _offset is not None:
+            return _offset
+        _offset = root_json.root_read("offset")
+        _max_finished = _offset - 1
+        try:
+            if os.path.exists(journal_filepath):
+                with open(journal_filepath, 'r') as f:
+                    for line in f:
+                        if line.strip():
+                            _remember_processed(int(line))
+                            if int(line) >= _offset:
+                                _finished_ahead.add(int(line))
+        except Exception as e:
+            log(f"Error reading processed update journal: {e}")
+        _journal = open(journal_filepath, 'a')
+        return _offset
 
+def _remember_processed(update_id):
+    """Add an update id to the processed ring buffer"""
+    if update_id in _processed_set:
+        return
+    if len(_processed_ids) == _processed_ids.maxlen:
+        _processed_set.discard(_processed_ids[0])
+    _processed_ids.append(update_id)
+    _processed_set.add(update_id)
+
+def already_processed(update_id):
+    """Check if an update was handled before (e.g. replayed after a crash)"""
+    with _checkpoint_lock:
+        return update_id in _processed_set
+
+def mark_processed(update_id):
+    """Record a handled update and commit the offset when a checkpoint is due"""
+    global _offset, _pending_updates, _max_finished
+    with _checkpoint_lock:
+        _remember_processed(update_id)
+        try:
+            _journal.write(f"{update_id}\n")
+            _journal.flush()
+        except Exception as e:
+            log(f"Error writing processed update journal: {e}")
+        _in_flight.discard(update_id)
+        _max_finished = max(_max_finished, update_id)
+        # Updates are dispatched in order, so everything below the lowest unfinished one is done
+        offset = max(_offset, min(_in_flight) if _in_flight else _max_finished + 1)
+        if offset != _offset:
+            _offset = offset
+            _finished_ahead.difference_update([finished for finished in _finished_ahead if finished < offset])
+        if update_id >= _offset:
+            _finished_ahead.add(update_id)
+        _pending_updates += 1
+
+        if _pending_updates >= CHECKPOINT_EVERY or time.monotonic() - _last_checkpoint >= CHECKPOINT_INTERVAL:
+            commit_offset()
+
+def mark_dispatched(update_id):
+    """Record an update handed to a worker, holding the offset back until it finishes"""
+    with _checkpoint_lock:
+        _in_flight.add(update_id)
+
+def commit_offset():
+    """Write the current offset to root.json and drop the journal entries below it"""
+    global _pending_updates, _last_checkpoint
+    with _checkpoint_lock:
+        if _offset is None or _pending_updates == 0:
+            return
+        try:
+            root_json.root_write("offset", _offset)
+            # Updates that finished ahead of an unfinished one are replayed from the offset,
+            # so their ids stay in the journal to be skipped again after a restart
+            _journal.seek(0)
+            _journal.truncate()
+            _journal.write("".join(f"{update_id}\n" for update_id in sorted(_finished_ahead)))
+            _journal.flush()
+            _prune_spool()
+            _pending_updates = 0
+        except Exception as e:
+            log(f"Error committing offset {_offset}: {e}")
+        _last_checkpoint = time.monotonic()
+
+def spool_updates(updates):
+    """Save received updates to disk before they are acknowledged to Telegram"""
+    global _spool
+    with _checkpoint_lock:
+        try:
+            if _spool is None:
+                _spool = open(spool_filepath, 'a')
+            for result in updates:
+                if result.get('update_id') is not None and result['update_id'] not in _spooled:
+                    _spooled[result['update_id']] = result
+                    _spool.write(json.dumps(result) + "\n")
+            _spool.flush()
+            os.fsync(_spool.fileno())
+        except Exception as e:
+            log(f"Error writing received updates: {e}")
+
+def _prune_spool():
+    """Rewrite the spool with the updates not handled yet"""
+    # Queued webhook deliveries are held in flight, so an id below the offset is handled
+    for update_id in [update_id for update_id in _spooled
+                      if (update_id < _offset and update_id not in _in_flight) or update_id in _finished_ahead]:
+        del _spooled[update_id]
+    if _spool is not None:
+        _spool.seek(0)
+        _spool.truncate()
+        _spool.write("".join(json.dumps(_spooled[update_id]) + "\n" for update_id in sorted(_spooled)))
+        _spool.flush()
+
+def replay_spool():
+    """Get the spooled updates left unhandled by the last run, in order"""
+    _load_checkpoint()
+    with _checkpoint_lock:
+        try:
+            if os.path.exists(spool_filepath):
+                with open(spool_filepath, 'r') as f:
+                    for line in f:
+                        if line.strip():
+                            result = json.loads(line)
+                            _spooled[result['update_id']] = result
+        except Exception as e:
+            log(f"Error reading received updates: {e}")
+        updates = [_spooled[update_id] for update_id in sorted(_spooled) if not already_processed(update_id)]
+    if updates:
+        log(f"Replaying {len(updates)} received updates left unhandled")
+    return updates
+
+def process_update(result):
+    """Dispatch a single update to its handler"""
+    # Handle regular message
+    message = result.get('message')
+    if message:
+        handle_message(message)
+
+    # Handle edited message
+    edited_message = result.get('edited_message')
+    if edited_message:
+        handle_edited_message(edited_message)
+
+    # Handle callback query
+    elif 'callback_query' in result:
+        cb = result['callback_query']
+        item = cb['data']
+        callback(text=item, result=cb)
+
+def fetch_updates(offset, TIMEOUT, limit=MAX_UPDATES_PER_FETCH):
+    """Long-poll getUpdates from offset, returns the updates or None on error"""
+    BASE_URL = root_json.root_read("BASE_URL")
     try:
-        resp = requests.get(f"{BASE_URL}/getUpdates", params={"offset": offset, "timeout": TIMEOUT},
-                            timeout=TIMEOUT + 5)
+        resp = http_client.get(f"{BASE_URL}/getUpdates", params={"offset": offset, "timeout": TIMEOUT, "limit": limit},
+                               timeout=TIMEOUT + 5)
         resp.raise_for_status()
-        data = resp.json()
+        return resp.json().get('result', [])
     except (requests.exceptions.RequestException, ValueError) as e:
         log(f"Error fetching updates: {e}")
+        return None
+
+def handle_update(result):
+    """Handle one update unless it was processed before, then record it"""
+    update_id = result.get('update_id')
+    if update_id is not None and already_processed(update_id):
+        log(f"Skipping already processed update {update_id}")
+        mark_processed(update_id)
         return
 
-    for result in data.get('result', []):
-        try:
-            # Handle regular message
-            message = result.get('message')
-            if message:
-                handle_message(message)
+    try:
+        process_update(result)
+    except Exception as e:
+        log(f"Error processing update: {e}")
+
+    if update_id is not None:
+        mark_processed(update_id)
+
+def read_msg(TIMEOUT):
+    """Fetch one batch of updates and handle it in this thread"""
+    updates = fetch_updates(_load_checkpoint(), TIMEOUT)
+    if updates is None:
+        return
 
-            # Handle edited message
-            edited_message = result.get('edited_message')
-            if edited_message:
-                handle_edited_message(edited_message)
+    for result in updates:
+        handle_update(result)
+
+    # Commit once per getUpdates batch
+    commit_offset()
+
+def _fetch_forever(TIMEOUT):
+    """Long-poll continuously and queue the updates, blocking while the queue is full
+
+    Each batch is spooled to disk before the next getUpdates acknowledges
+    it, so updates still queued when the bot stops are replayed on start.
+    """
+    offset = _load_checkpoint()
+    for result in replay_spool():
+        _updates.put(result)
+        offset = max(offset, result['update_id'] + 1)
+    while True:
+        # Only ask for as many updates as the queue has room for
+        limit = max(1, min(MAX_UPDATES_PER_FETCH, UPDATE_QUEUE_SIZE - _updates.qsize()))
+        updates = fetch_updates(offset, TIMEOUT, limit)
+        if updates is None:
+            time.sleep(FETCH_RETRY_DELAY)
+            continue
+        spool_updates(updates)
+        for result in updates:
+            _updates.put(result)
+            if result.get('update_id') is not None:
+                offset = max(offset, result['update_id'] + 1)
+
+def start_fetcher(TIMEOUT):
+    """Start the thread that fetches updates into the queue"""
+    global _fetcher
+    if _fetcher is None:
+        _fetcher = threading.Thread(target=_fetch_forever, args=(TIMEOUT,), name="update-fetcher", daemon=True)
+        _fetcher.start()
+
+def queue_update(result, timeout=None):
+    """Queue an update pushed from outside the fetcher (webhook), returns False if the queue stayed full"""
+    update_id = result.get('update_id')
+    # Spool and hold the update before a worker can see it, deliveries can arrive out of order
+    spool_updates([result])
+    if update_id is not None:
+        mark_dispatched(update_id)
+    try:
+        _updates.put(result, timeout=timeout)
+        return True
+    except queue.Full:
+        # Telegram redelivers a refused update, so it isn't kept
+        with _checkpoint_lock:
+            _in_flight.discard(update_id)
+            _spooled.pop(update_id, None)
+        return False
+
+def update_chat_id(result):
+    """Get the chat an update belongs to, used to keep each chat's updates in order"""
+    for field in ('message', 'edited_message'):
+        if result.get(field):
+            return result[field].get('chat', {}).get('id')
+    if 'callback_query' in result:
+        return result['callback_query'].get('from', {}).get('id')
+    return None
 
-            # Handle callback query
-            elif 'callback_query' in result:
-                cb = result['callback_query']
-                item = cb['data']
-                callback(text=item, result=cb)
+def get_workers():
+    """Get the per-chat handler pool, started on first use"""
+    global _workers
+    if _workers is None:
+        _workers = ChatWorkerPool(handle_update, UPDATE_WORKERS, UPDATE_WORKER_QUEUE, name="update-worker")
+    return _workers
+
+def dispatch_update(result):
+    """Hand an update to its chat's worker, or handle it here without workers"""
+    if UPDATE_WORKERS <= 0:
+        handle_update(result)
+        return
+    update_id = result.get('update_id')
+    if update_id is not None:
+        mark_dispatched(update_id)
+    get_workers().submit(update_chat_id(result), result)
 
-            root_json.root_write("offset", result["update_id"] + 1)
+def chat_pending_counts():
+    """Get {chat_id: updates queued or running} for chats with updates in the workers"""
+    return get_workers().pending_counts() if _workers is not None else {}
 
-        except Exception as e:
-            log(f"Error processing update: {e}")
-            if 'update_id' in result:
-                root_json.root_write("offset", result["update_id"] + 1)
+def process_pending(timeout=None):
+    """Dispatch queued updates, waiting up to timeout for the first; returns how many were dispatched"""
+    try:
+        result = _updates.get(timeout=timeout)
+    except queue.Empty:
+        commit_offset()
+        return 0
+
+    handled = 0
+    while True:
+        dispatch_update(result)
+        handled += 1
+        try:
+            result = _updates.get_nowait()
+        except queue.Empty:
+            break
+
+    # Commit once the queue is drained, up to the updates the workers have finished
+    commit_offset()
+    return handled
+
+def pending_updates():
+    """Get the number of fetched updates waiting to be handled"""
+    return _updates.qsize()
+
+metrics.register_gauge("pending_updates", pending_updates)
+metrics.register_gauge("busy_chats", lambda: len(chat_pending_counts()))
+metrics.register_gauge("max_chat_pending_updates", lambda: max(chat_pending_counts().values(), default=0))
 
 def handle_message(message):
     """Handle incoming messages of all types"""
@@ -158,86 +454,80 @@ def handle_edited_message(edited_message):
     partner_id = match.check_matched(chat_id)
     if partner_id:
         try:
-            # Get user gender for emoji
-            data = user_json.user_read(str(chat_id))
-            gender = data["gender"]
-            emoji = "🧒" if gender == "Female" else "👦"
-
-            if 'text' in edited_message:
-                # Forward edited text message
-                edited_text = edited_message['text']
-                send_message(chat_id=partner_id,
-                             text=f"{emoji} ✏️ (edited): {edited_text}")
-            else:
-                # For media messages, just notify about the edit
-                send_message(chat_id=partner_id,
-                             text=f"{emoji} ✏️ Your partner edited their message")
+            for method, data in edit_relay_calls(chat_id, partner_id, edited_message):
+                call_method(method, data)
 
         except Exception as e:
             log(f"Error forwarding edited message: {e}")
             send_message(chat_id=chat_id, text="Error sending edited message to partner")
 
+def partner_emoji(chat_id):
+    """Get the emoji a user's messages are shown with to their partner"""
+    data = user_json.user_read(str(chat_id))
+    return "🧒" if data["gender"] == "Female" else "👦"
+
+def relay_calls(chat_id, partner_id, message, message_type):
+    """Get the (method, data) Bot API calls that relay a message to the partner
+
+    Shared by forward_to_partner and the asyncio runtime, which only differ
+    in how the calls are sent.
+    """
+    emoji = partner_emoji(chat_id)
+
+    if message_type == 'text':
+        return [("sendMessage", {"chat_id": partner_id, "text": emoji + " " + message['text']})]
+
+    elif message_type == 'photo':
+        # Last element is the largest size
+        caption = message.get('caption', '')
+        return [("sendPhoto", {"chat_id": partner_id, "photo": message['photo'][-1]['file_id'],
+                               "caption": f"{emoji} {caption}" if caption else f"{emoji} sent a photo"})]
+
+    elif message_type == 'document':
+        caption = message.get('caption', '')
+        return [("sendDocument", {"chat_id": partner_id, "document": message['document']['file_id'],
+                                  "caption": f"{emoji} {caption}" if caption else f"{emoji} sent a document"})]
+
+    elif message_type == 'voice':
+        voice = message['voice']
+        data = {"chat_id": partner_id, "voice": voice['file_id'], "caption": f"{emoji} sent a voice message"}
+        if voice.get('duration'):
+            data["duration"] = voice['duration']
+        return [("sendVoice", data)]
+
+    elif message_type == 'video':
+        # Copying preserves the video format better
+        return [("copyMessage", {"chat_id": partner_id, "from_chat_id": chat_id,
+                                 "message_id": message['message_id'], "caption": f"{emoji} sent a video"})]
+
+    elif message_type in ('sticker', 'location'):
+        notice = f"{emoji} sent a sticker" if message_type == 'sticker' else f"{emoji} shared their location"
+        return [("copyMessage", {"chat_id": partner_id, "from_chat_id": chat_id, "message_id": message['message_id']}),
+                ("sendMessage", {"chat_id": partner_id, "text": notice})]
+
+    return []
+
+def edit_relay_calls(chat_id, partner_id, edited_message):
+    """Get the (method, data) Bot API calls that tell the partner about an edited message"""
+    emoji = partner_emoji(chat_id)
+    if 'text' in edited_message:
+        # Forward edited text message
+        text = f"{emoji} ✏️ (edited): {edited_message['text']}"
+    else:
+        # For media messages, just notify about the edit
+        text = f"{emoji} ✏️ Your partner edited their message"
+    return [("sendMessage", {"chat_id": partner_id, "text": text})]
+
 def forward_to_partner(chat_id, message, message_type):
     """Forward different types of messages to matched partner"""
     partner_id = match.check_matched(chat_id)
     if not partner_id:
         return
+    match.touch_match(chat_id)
 
     try:
-        # Get user gender for emoji
-        data = user_json.user_read(str(chat_id))
-        gender = data["gender"]
-        emoji = "🧒" if gender == "Female" else "👦"
-
-        if message_type == 'text':
-            text = message['text']
-            send_message(chat_id=partner_id, text=(emoji + " " + text))
-
-        elif message_type == 'photo':
-            # Get the largest photo size
-            photo = message['photo'][-1]  # Last element is largest size
-            file_id = photo['file_id']
-            caption = message.get('caption', '')
-            if caption:
-                caption = f"{emoji} {caption}"
-            else:
-                caption = f"{emoji} sent a photo"
-            send_photo(chat_id=partner_id, photo=file_id, caption=caption)
-
-        elif message_type == 'document':
-            document = message['document']
-            file_id = document['file_id']
-            caption = message.get('caption', '')
-            if caption:
-                caption = f"{emoji} {caption}"
-            else:
-                filename = document.get('file_name', 'document')
-                caption = f"{emoji} sent a document"
-            send_document(chat_id=partner_id, document=file_id, caption=caption)
-
-        elif message_type == 'voice':
-            voice = message['voice']
-            file_id = voice['file_id']
-            duration = voice.get('duration', 0)
-            caption = f"{emoji} sent a voice message"
-            send_voice(chat_id=partner_id, voice=file_id, caption=caption, duration=duration)
-
-        elif message_type == 'video':
-            # Use copy_message for video as it preserves format better
-            copy_message(chat_id=partner_id, from_chat_id=chat_id,
-                         message_id=message['message_id'], caption=f"{emoji} sent a video")
-
-        elif message_type == 'sticker':
-            # Use copy_message for stickers
-            copy_message(chat_id=partner_id, from_chat_id=chat_id,
-                         message_id=message['message_id'])
-            send_message(chat_id=partner_id, text=f"{emoji} sent a sticker")
-
-        elif message_type == 'location':
-            # Use copy_message for location
-            copy_message(chat_id=partner_id, from_chat_id=chat_id,
-                         message_id=message['message_id'])
-            send_message(chat_id=partner_id, text=f"{emoji} shared their location")
+        for method, data in relay_calls(chat_id, partner_id, message, message_type):
+            call_method(method, data)
 
     except Exception as e:
         log(f"Error forwarding {message_type} message: {e}")
@@ -477,6 +767,16 @@ def callback(text, result):
         except Exception as e:
             log(f"Error handling settings callback for {result.get('from', {}).get('id', 'Unknown')}: {e}")
 
+    elif text.startswith("lobby:keep"):
+        try:
+            chat_id = result["from"]["id"]
+            if lobby.touch_lobby_entry(chat_id):
+                send_message(chat_id=chat_id, text="Great, you're still in the lobby. Looking for a partner... 🔍")
+            else:
+                send_message(chat_id=chat_id, text="You're no longer in the lobby.\nUse /connect to find a partner!")
+        except Exception as e:
+            log(f"Error handling lobby callback for {result.get('from', {}).get('id', 'Unknown')}: {e}")
+
     elif text.startswith("pref:"):
         try:
             preference = text.split(":", 1)[1]
@@ -497,7 +797,7 @@ def commands(text, chat_id):
             try:
                 referrer_id = int(referral_code)
                 # Check if referrer exists
-                if str(referrer_id) in user_json.user_read_untagged():
+                if user_json.user_exists(referrer_id):
                     if referrer_id != chat_id:  # Prevent self-referral
                         log(f"Valid referral code detected: {referral_code} from {referrer_id}")
                     else:
@@ -533,7 +833,7 @@ Let's get started! Please select your gender below:
 
         send_message(text=start_text, chat_id=chat_id)
 
-        if str(chat_id) not in list(user_json.user_read_untagged().keys()):
+        if not user_json.user_exists(chat_id):
             gender_buttons = {
                 "inline_keyboard": [
                     [{"text": "Male", "callback_data": "gender:Male"}],
@@ -562,7 +862,7 @@ Let's get started! Please select your gender below:
 
     elif text.startswith("/refer"):
         try:
-            if str(chat_id) not in user_json.user_read_untagged().keys():
+            if not user_json.user_exists(chat_id):
                 send_message(text="Please use /start first to set up your profile!", chat_id=chat_id)
                 return
 
@@ -596,7 +896,7 @@ When 5 people join using your link, you'll get VIP membership for 30 days!
 
     elif text.startswith("/stats"):
         try:
-            if str(chat_id) not in user_json.user_read_untagged().keys():
+            if not user_json.user_exists(chat_id):
                 send_message(text="Please use /start first to set up your profile!", chat_id=chat_id)
                 return
 
@@ -685,7 +985,7 @@ Enjoy chatting! 🎉
     elif text.startswith("/connect"):
         try:
             # Check if user exists
-            if str(chat_id) not in user_json.user_read_untagged().keys():
+            if not user_json.user_exists(chat_id):
                 send_message(text="Please use /start first to set up your profile!", chat_id=chat_id)
                 return
 
@@ -774,7 +1074,7 @@ Enjoy chatting! 🎉
     elif text.startswith("/settings"):
         try:
             # Check if user exists
-            if str(chat_id) not in user_json.user_read_untagged().keys():
+            if not user_json.user_exists(chat_id):
                 send_message(text="Please use /start first to set up your profile!", chat_id=chat_id)
                 return
 
@@ -0,0 +1,43 @@
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '32'))  # Kept-alive connections per host
+CONNECT_TIMEOUT = 5  # Seconds to open a connection
+READ_TIMEOUT = 30  # Seconds to wait for a response
+TRANSFER_TIMEOUT = 120  # Read timeout for file uploads and downloads
+
+_session = None
+_lock = threading.Lock()
+
+
+def get_session():
+    """Get the shared session, so calls reuse open connections instead of a new TCP+TLS handshake each"""
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+
+def post(url, timeout=READ_TIMEOUT, **kwargs):
+    """POST through the shared session, timeout is the read timeout in seconds"""
+    return get_session().post(url, timeout=(CONNECT_TIMEOUT, timeout), **kwargs)
+
+
+def get(url, timeout=READ_TIMEOUT, **kwargs):
+    """GET through the shared session, timeout is the read timeout in seconds"""
+    return get_session().get(url, timeout=(CONNECT_TIMEOUT, timeout), **kwargs)
+
+
+def close():
+    """Close the session and its pooled connections"""
+    global _session
+    with _lock:
+        if _session is not None:
+            _session.close()
+            _session = None
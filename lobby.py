@@ -1,60 +1,109 @@
 from user_json import user_read
-import json
 import os
+import threading
+import time
+import storage
+import match_registry
+import metrics
+from email_verification import extract_domain
+from lobby_index import LobbyQueue
 from log import log
-from send_updates import send_message
+from send_updates import send_message, send_messages
 
 filepath = os.path.join(os.path.dirname(__file__), "Json Files", "lobby.json")
 matches_filepath = os.path.join(os.path.dirname(__file__), "Json Files", "matches.json")
 
+# Process-wide lobby queue, loaded from storage on first use
+_queue = None
+_lock = threading.RLock()
+
+# Callbacks run with the chat id of every user added to the lobby
+_insert_listeners = []
+
+LOBBY_TTL_SECONDS = 1800  # Users idle in the lobby this long are pinged or evicted
+LOBBY_PING_ENABLED = True  # Ask "still searching?" before evicting
+LOBBY_PING_GRACE_SECONDS = 300  # Time to answer the ping before eviction
+LOBBY_REAP_INTERVAL = 60  # Seconds between reaper runs
+
 def check_match(chat_id):
     try:
-        with open(matches_filepath, 'r') as f:
-            matches = json.load(f)
+        return match_registry.is_matched(chat_id)
     except:
-        matches = {}
-
-    chat_id_str = str(chat_id)
-    if chat_id_str in matches:
-        return True
-    return False
+        return False
 
 
 def initialize_lobby():
     """Initialize lobby file if it doesn't exist"""
-    if not os.path.exists(filepath):
-        os.makedirs(os.path.dirname(filepath), exist_ok=True)
-        with open(filepath, 'w') as f:
-            json.dump({}, f)
+    storage.get_backend().initialize("lobby")
+
+
+def get_queue():
+    """Get the in-memory lobby queue"""
+    global _queue
+    with _lock:
+        if _queue is None:
+            queue = LobbyQueue()
+            try:
+                lobby_data = storage.get_backend().all("lobby")
+            except Exception as e:
+                log(f"Error loading lobby: {e}")
+                lobby_data = {}
+            now = time.time()
+            for chat_id, entry in lobby_data.items():
+                if match_registry.is_matched(chat_id):
+                    continue  # Matched in a round that stopped before clearing the lobby
+                entry.setdefault("joined_at", now)  # Older entries have no enqueue time
+                entry.setdefault("last_active", entry["joined_at"])
+                queue.push(chat_id, entry)
+            _queue = queue
+        return _queue
+
+
+def add_lobby_listener(callback):
+    """Register a callback to run whenever a user is added to the lobby"""
+    _insert_listeners.append(callback)
+
+
+def _emit_insert(chat_id):
+    """Run the lobby insert callbacks for a user"""
+    for callback in _insert_listeners:
+        try:
+            callback(chat_id)
+        except Exception as e:
+            log(f"Error in lobby listener for chat_id {chat_id}: {e}")
 
 
 def add_to_lobby(chat_id, match_org=False):
     """Add user to lobby for matching"""
     if check_match(chat_id) == False:
         try:
-            initialize_lobby()
             user_data = user_read(chat_id)
             gender = user_data["gender"]
             prefer = user_data.get("prefer", "Any")  # Default to Any if not set
             user_type = user_data.get("type", "Free")  # Default to Free if not set
+            domain = extract_domain(user_data.get("email") or "")  # Used for organisation matching
 
-            # Read current lobby data
-            with open(filepath, 'r') as lobbyfile:
-                lobby_data = json.load(lobbyfile)
+            with _lock:
+                queue = get_queue()
+                # Users already waiting keep their place in the queue
+                existing = queue.entries.get(str(chat_id))
+                joined_at = existing["joined_at"] if existing else time.time()
 
-            # Add or update entry
-            lobby_data[str(chat_id)] = {
-                "gender": gender,
-                "prefer": prefer,
-                "type": user_type,
-                "match_org": match_org
-            }
-
-            # Save back to file
-            with open(filepath, 'w') as lobby_file:
-                json.dump(lobby_data, lobby_file, indent=4)
+                # Add or update entry
+                entry = {
+                    "gender": gender,
+                    "prefer": prefer,
+                    "type": user_type,
+                    "match_org": match_org,
+                    "domain": domain,
+                    "joined_at": joined_at,
+                    "last_active": time.time()
+                }
+                storage.get_backend().put("lobby", chat_id, entry)
+                queue.push(chat_id, entry)
 
             log(f"Added user {chat_id} to lobby - Gender: {gender}, Prefer: {prefer}")
+            _emit_insert(str(chat_id))
 
         except Exception as e:
             log(f"Error adding to lobby for chat_id {chat_id}: {e}")
@@ -64,39 +113,89 @@ def add_to_lobby(chat_id, match_org=False):
 
 
 
-def remove_from_lobby(chat_id):
+def update_lobby_entry(chat_id, **fields):
+    """Change fields of a waiting user's entry, keeping their place in the queue"""
+    with _lock:
+        queue = get_queue()
+        entry = queue.entries.get(str(chat_id))
+        if entry is None:
+            return False
+        entry = dict(entry, **fields)
+        storage.get_backend().put("lobby", chat_id, entry)
+        queue.push(chat_id, entry)
+        return True
+
+
+def remove_from_lobby(chat_id, matched=False):
     """Remove user from lobby"""
     try:
-        initialize_lobby()
-        chat_id_str = str(chat_id)
+        with _lock:
+            get_queue().remove(chat_id, matched=matched)
+
+            # Remove user if they exist in lobby
+            if storage.get_backend().delete("lobby", chat_id):
+                log(f"Removed user {chat_id} from lobby")
 
-        with open(filepath, 'r') as lobbyfile:
-            lobby_data = json.load(lobbyfile)
+    except Exception as e:
+        log(f"Error removing from lobby for chat_id {chat_id}: {e}")
 
-        # Remove user if they exist in lobby
-        if chat_id_str in lobby_data:
-            del lobby_data[chat_id_str]
 
-            # Save updated lobby
-            with open(filepath, 'w') as lobby_file:
-                json.dump(lobby_data, lobby_file, indent=4)
+def remove_many_from_lobby(chat_ids, matched=False):
+    """Remove several users from lobby with one storage write"""
+    try:
+        with _lock:
+            queue = get_queue()
+            for chat_id in chat_ids:
+                queue.remove(chat_id, matched=matched)
 
-            log(f"Removed user {chat_id} from lobby")
+            removed = storage.get_backend().delete_many("lobby", chat_ids)
+            log(f"Removed {removed} users from lobby")
+            return removed
 
     except Exception as e:
-        log(f"Error removing from lobby for chat_id {chat_id}: {e}")
+        log(f"Error removing {len(chat_ids)} users from lobby: {e}")
+        return 0
+
+
+def remove_pairs_from_lobby(pairs, commit=None):
+    """Remove the (user1_id, user2_id) pairs whose users are both still waiting, returns those pairs
+
+    Pairs with a user who already left are skipped. commit(pairs) runs
+    under the lobby lock before the users are removed, so nobody can leave
+    or rejoin in between.
+    """
+    try:
+        with _lock:
+            queue = get_queue()
+            taken = set()
+            present = []
+            for user1_id, user2_id in pairs:
+                user1_id, user2_id = str(user1_id), str(user2_id)
+                if (user1_id != user2_id and user1_id in queue.entries and user2_id in queue.entries
+                        and user1_id not in taken and user2_id not in taken):
+                    taken.update((user1_id, user2_id))
+                    present.append((user1_id, user2_id))
+            if not present:
+                return []
+
+            # A failed commit leaves everyone waiting
+            if commit is not None:
+                commit(present)
+            for chat_id in taken:
+                queue.remove(chat_id, matched=True)
+            removed = storage.get_backend().delete_many("lobby", list(taken))
+            log(f"Removed {removed} users from lobby")
+            return present
+
+    except Exception as e:
+        log(f"Error removing {len(pairs)} pairs from lobby: {e}")
+        return []
 
 
 def tot_lobby():
     """Get total number of users in lobby"""
     try:
-        initialize_lobby()
-        if os.path.exists(filepath):
-            with open(filepath, 'r') as f:
-                lobby_data = json.load(f)
-            return len(lobby_data)
-        else:
-            return 0
+        return len(get_queue())
     except Exception as e:
         log(f"Error getting lobby count: {e}")
         return 0
@@ -105,19 +204,96 @@ def tot_lobby():
 def get_lobby_users():
     """Get all users currently in lobby"""
     try:
-        initialize_lobby()
-        with open(filepath, 'r') as f:
-            lobby_data = json.load(f)
-        return lobby_data
+        with _lock:
+            return {chat_id: dict(entry) for chat_id, entry in get_queue().entries.items()}
     except Exception as e:
         log(f"Error getting lobby users: {e}")
         return {}
 
 
+def get_lobby_order():
+    """Get (chat_id, entry, effective_priority) for all waiting users in matching order"""
+    with _lock:
+        return get_queue().ordered()
+
+
+def find_lobby_partner(chat_id, recent=None):
+    """Get the waiting user that should be matched with chat_id, or None"""
+    with _lock:
+        return get_queue().find_partner(chat_id, recent=recent)
+
+
+def get_lobby_entry(chat_id):
+    """Get a copy of a waiting user's lobby entry, or None"""
+    with _lock:
+        entry = get_queue().entries.get(str(chat_id))
+        return dict(entry) if entry else None
+
+
+def get_wait_time_stats():
+    """Get wait-time percentiles of recently matched users"""
+    with _lock:
+        return get_queue().wait_time_percentiles()
+
+
+def touch_lobby_entry(chat_id):
+    """Mark a waiting user as still searching"""
+    return update_lobby_entry(chat_id, last_active=time.time(), pinged_at=None)
+
+
+def reap_lobby(now=None):
+    """Ping or evict users idle in the lobby longer than LOBBY_TTL_SECONDS, returns how many were evicted"""
+    now = time.time() if now is None else now
+    pinged = {}
+    evicted = []
+    with _lock:
+        queue = get_queue()
+        # Only users idle past the TTL come off the activity heap
+        for chat_id in queue.pop_idle(now - LOBBY_TTL_SECONDS):
+            entry = queue.entries[chat_id]
+            pinged_at = entry.get("pinged_at")
+            if LOBBY_PING_ENABLED and pinged_at is None:
+                pinged[chat_id] = dict(entry, pinged_at=now)
+            elif not LOBBY_PING_ENABLED or now - pinged_at >= LOBBY_PING_GRACE_SECONDS:
+                evicted.append(chat_id)
+            else:
+                queue.push(chat_id, entry)  # Still within the grace period, checked again next run
+
+        for chat_id, entry in pinged.items():
+            queue.push(chat_id, entry)
+        if pinged:
+            storage.get_backend().put_many("lobby", pinged)
+        if evicted:
+            remove_many_from_lobby(evicted)
+
+    if pinged:
+        keep_button = {"inline_keyboard": [[{"text": "Keep searching", "callback_data": "lobby:keep"}]]}
+        send_messages([(chat_id, "Still searching for a partner? 🔍\nTap below to stay in the lobby.", keep_button)
+                       for chat_id in pinged])
+        metrics.increment("lobby_pings", len(pinged))
+
+    if evicted:
+        send_messages([(chat_id, "You were removed from the lobby after waiting too long.\nUse /connect to search again!")
+                       for chat_id in evicted])
+        metrics.increment("lobby_evictions", len(evicted))
+        log(f"Evicted {len(evicted)} idle users from lobby")
+
+    return len(evicted)
+
+
+def get_average_lobby_age():
+    """Get the average time in seconds waiting users have been in the lobby"""
+    with _lock:
+        return get_queue().average_age()
+
+
+metrics.register_gauge("lobby_users", tot_lobby)
+metrics.register_gauge("lobby_average_age_seconds", lambda: round(get_average_lobby_age(), 1))
+
+
 def is_in_lobby(chat_id):
     """Check if user is currently in lobby"""
     try:
-        lobby_data = get_lobby_users()
-        return str(chat_id) in lobby_data
+        return chat_id in get_queue()
     except:
         return False
\ No newline at end of file
@@ -0,0 +1,359 @@
+import heapq
+import itertools
+import math
+import time
+from collections import defaultdict, deque
+from email_verification import extract_domain
+from user_json import user_read
+from log import log
+
+
+def entry_domain(user_id, entry):
+    """Get the email domain of a lobby entry, reading the user for older entries"""
+    if "domain" in entry:
+        return entry["domain"]
+    try:
+        email = user_read(user_id).get("email") or ""
+        return extract_domain(email)
+    except Exception as e:
+        log(f"Error reading email domain for {user_id}: {e}")
+        return None
+
+
+def bucket_key(user_id, entry):
+    """Get the (gender, preference, org domain) bucket of a lobby entry
+
+    Open category users share the domain None; org users without a domain
+    get no bucket since they can't match anyone.
+    """
+    gender = entry.get("gender")
+    prefer = entry.get("prefer", "Any")
+    if entry.get("match_org", False):
+        domain = entry_domain(user_id, entry)
+        if not domain:
+            return None
+        return (gender, prefer, True, domain)
+    return (gender, prefer, False, None)
+
+
+def keys_compatible(key1, key2):
+    """Check if users from two buckets can be matched"""
+    gender1, prefer1, match_org1, domain1 = key1
+    gender2, prefer2, match_org2, domain2 = key2
+    if match_org1 != match_org2 or domain1 != domain2:
+        return False
+    return (prefer1 == "Any" or prefer1 == gender2) and (prefer2 == "Any" or prefer2 == gender1)
+
+
+class LobbyIndex:
+    """Lobby entries grouped into buckets, each kept in priority order"""
+
+    def __init__(self, ordered_users, recent=None):
+        # ordered_users is a list of (user_id, user_data, priority), highest priority first
+        self.users = ordered_users
+        self.recent = recent  # RecentPairs of users that must not be paired again yet
+        self.keys = []
+        self.buckets = defaultdict(deque)
+        self.matched = set()
+        self._compatible = {}
+
+        for position, (user_id, user_data, priority) in enumerate(ordered_users):
+            key = bucket_key(user_id, user_data)
+            self.keys.append(key)
+            if key is not None:
+                self.buckets[key].append(position)
+
+    def compatible_buckets(self, key):
+        """Get the bucket keys whose users can be matched with key"""
+        if key not in self._compatible:
+            self._compatible[key] = [other for other in self.buckets if keys_compatible(key, other)]
+        return self._compatible[key]
+
+    def find_partner(self, position):
+        """Get the highest-priority unmatched position compatible with position"""
+        key = self.keys[position]
+        if key is None:
+            return None
+
+        best = None
+        for other in self.compatible_buckets(key):
+            bucket = self.buckets[other]
+            # Earlier unmatched users in a compatible bucket already failed to
+            # match this one, so heads at or before position can be dropped
+            while bucket and (bucket[0] <= position or bucket[0] in self.matched):
+                bucket.popleft()
+            candidate = self._first_allowed(bucket, position, best)
+            if candidate is not None:
+                best = candidate
+        return best
+
+    def _first_allowed(self, bucket, position, best):
+        """Get the first unmatched position of a bucket before best not recently paired with position"""
+        for candidate in bucket:
+            if best is not None and candidate >= best:
+                return None
+            if candidate in self.matched:
+                continue
+            if self.recent is None or not self.recent.contains(self.users[position][0], self.users[candidate][0]):
+                return candidate
+        return None
+
+    def pairs(self):
+        """Greedily pair users in priority order, yielding position pairs"""
+        for position in range(len(self.users)):
+            if position in self.matched:
+                continue
+            partner = self.find_partner(position)
+            if partner is not None:
+                self.matched.update((position, partner))
+                yield position, partner
+
+
+def greedy_pairs(ordered_users, recent=None):
+    """Pair the lobby with the bucketed greedy index, returning position pairs"""
+    return list(LobbyIndex(ordered_users, recent).pairs())
+
+
+VIP_PRIORITY = 10  # Base priority of VIP users
+FREE_PRIORITY = 1  # Base priority of Free users
+AGING_POINTS_PER_MINUTE = 1.0  # Priority every waiting user gains per minute
+MAX_WAIT_SECONDS = 600  # Users waiting longer than this are matched first, oldest first
+WAIT_SAMPLES = 10000  # Recent wait times kept for percentile reporting
+
+
+def base_priority(entry):
+    """Get the base priority of a lobby entry from its membership type"""
+    return VIP_PRIORITY if entry.get("type", "Free") == "VIP" else FREE_PRIORITY
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """Get nearest-rank percentiles of a list of numbers"""
+    if not values:
+        return {f"p{point}": 0 for point in points}
+    ordered = sorted(values)
+    return {f"p{point}": ordered[min(len(ordered) - 1, int(len(ordered) * point / 100))] for point in points}
+
+
+class LobbyQueue:
+    """Lobby ordered by effective priority with wait-time aging
+
+    Effective priority is the base priority plus AGING_POINTS_PER_MINUTE for
+    every minute waited. Since everyone ages at the same rate, the order only
+    depends on joined_at - priority / rate, which is fixed at enqueue time and
+    can be kept in a heap. A second heap ordered by joined_at lets users past
+    MAX_WAIT_SECONDS jump the queue, and a third ordered by last_active lets
+    the reaper find idle users without scanning the lobby.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self._heap = []
+        self._fifo = []
+        self._activity = []
+        self._tokens = {}
+        self._seq = itertools.count()
+        self.waits = deque(maxlen=WAIT_SAMPLES)
+        # Per-bucket (heap, fifo) pairs and bucket keys grouped by (match_org, domain)
+        self._keys = {}
+        self._buckets = {}
+        self._partitions = defaultdict(set)
+        self._joined_total = 0.0  # Sum of joined_at over entries, for the average age
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, chat_id):
+        return str(chat_id) in self.entries
+
+    def _order_key(self, entry):
+        seconds_per_point = 60 / AGING_POINTS_PER_MINUTE
+        return entry["joined_at"] - base_priority(entry) * seconds_per_point
+
+    def push(self, chat_id, entry):
+        """Add or update a lobby entry, O(log n)"""
+        chat_id = str(chat_id)
+        token = next(self._seq)
+        previous = self.entries.get(chat_id)
+        if previous is not None:
+            self._joined_total -= previous["joined_at"]
+        self._joined_total += entry["joined_at"]
+        self.entries[chat_id] = entry
+        self._tokens[chat_id] = token
+        order_item = (self._order_key(entry), token, chat_id)
+        fifo_item = (entry["joined_at"], token, chat_id)
+        heapq.heappush(self._heap, order_item)
+        heapq.heappush(self._fifo, fifo_item)
+        heapq.heappush(self._activity, (entry.get("last_active", entry["joined_at"]), token, chat_id))
+
+        key = bucket_key(chat_id, entry)
+        self._keys[chat_id] = key
+        if key is not None:
+            if key not in self._buckets:
+                self._buckets[key] = ([], [])
+                self._partitions[key[2:]].add(key)
+            heapq.heappush(self._buckets[key][0], order_item)
+            heapq.heappush(self._buckets[key][1], fifo_item)
+
+        if len(self._heap) > 2 * len(self.entries) + 64:
+            self._rebuild()
+
+    def remove(self, chat_id, matched=False, now=None):
+        """Remove a lobby entry, recording its wait time if it was matched"""
+        chat_id = str(chat_id)
+        entry = self.entries.pop(chat_id, None)
+        self._tokens.pop(chat_id, None)
+        self._keys.pop(chat_id, None)
+        if entry is not None:
+            self._joined_total -= entry["joined_at"]
+        if not self.entries:
+            self._joined_total = 0.0  # Drop the rounding drift of the running sum
+        if entry is not None and matched:
+            now = time.time() if now is None else now
+            self.waits.append((entry.get("type", "Free"), now - entry["joined_at"]))
+        return entry
+
+    def _valid(self, item):
+        return self._tokens.get(item[2]) == item[1]
+
+    def _rebuild(self):
+        """Drop stale heap items left behind by removals and updates"""
+        self._heap = [item for item in self._heap if self._valid(item)]
+        self._fifo = [item for item in self._fifo if self._valid(item)]
+        self._activity = [item for item in self._activity if self._valid(item)]
+        heapq.heapify(self._heap)
+        heapq.heapify(self._fifo)
+        heapq.heapify(self._activity)
+        self._joined_total = math.fsum(entry["joined_at"] for entry in self.entries.values())
+        for key in list(self._buckets):
+            heap, fifo = self._buckets[key]
+            heap[:] = [item for item in heap if self._valid(item)]
+            fifo[:] = [item for item in fifo if self._valid(item)]
+            if not heap:
+                del self._buckets[key]
+                self._partitions[key[2:]].discard(key)
+                if not self._partitions[key[2:]]:
+                    del self._partitions[key[2:]]
+                continue
+            heapq.heapify(heap)
+            heapq.heapify(fifo)
+
+    def peek(self, now=None):
+        """Get the chat id that should be matched next, O(log n) amortised"""
+        now = time.time() if now is None else now
+        while self._fifo and not self._valid(self._fifo[0]):
+            heapq.heappop(self._fifo)
+        while self._heap and not self._valid(self._heap[0]):
+            heapq.heappop(self._heap)
+        if self._fifo and now - self._fifo[0][0] > MAX_WAIT_SECONDS:
+            return self._fifo[0][2]
+        return self._heap[0][2] if self._heap else None
+
+    def pop(self, now=None):
+        """Remove and return the chat id that should be matched next"""
+        chat_id = self.peek(now)
+        if chat_id is not None:
+            self.remove(chat_id, now=now)
+        return chat_id
+
+    def pop_idle(self, cutoff):
+        """Take the chat ids last active at or before cutoff off the activity heap, O(log n) each
+
+        The entries stay in the lobby; pushing one again puts it back on the heap.
+        """
+        idle = []
+        while self._activity and self._activity[0][0] <= cutoff:
+            item = heapq.heappop(self._activity)
+            if self._valid(item):
+                idle.append(item[2])
+        return idle
+
+    def _head(self, heap, exclude, recent=None):
+        """Get the first valid item of a heap other than exclude and its recent partners"""
+        skipped = []
+        head = None
+        while heap:
+            if not self._valid(heap[0]):
+                heapq.heappop(heap)
+            elif heap[0][2] == exclude or (recent is not None and recent.contains(exclude, heap[0][2])):
+                skipped.append(heapq.heappop(heap))
+            else:
+                head = heap[0]
+                break
+        for item in skipped:
+            heapq.heappush(heap, item)
+        return head
+
+    def find_partner(self, chat_id, now=None, recent=None):
+        """Get the waiting user that should be matched with chat_id, O(log n) per bucket
+
+        Candidates come from the compatible buckets only; among them the
+        same order as ordered() applies. Users in recent (a RecentPairs)
+        with chat_id are skipped.
+        """
+        now = time.time() if now is None else now
+        chat_id = str(chat_id)
+        key = self._keys.get(chat_id)
+        if key is None:
+            return None
+
+        best = None
+        for other in self._partitions.get(key[2:], ()):
+            if not keys_compatible(key, other):
+                continue
+            heap, fifo = self._buckets[other]
+            oldest = self._head(fifo, chat_id, recent)
+            if oldest is not None and now - oldest[0] > MAX_WAIT_SECONDS:
+                rank = (0, oldest[0], oldest[1])
+                candidate = oldest[2]
+            else:
+                head = self._head(heap, chat_id, recent)
+                if head is None:
+                    continue
+                rank = (1, head[0], head[1])
+                candidate = head[2]
+            if best is None or rank < best[0]:
+                best = (rank, candidate)
+        return best[1] if best else None
+
+    def effective_priority(self, chat_id, now=None):
+        """Get a user's base priority plus aging"""
+        now = time.time() if now is None else now
+        entry = self.entries[str(chat_id)]
+        return base_priority(entry) + AGING_POINTS_PER_MINUTE * (now - entry["joined_at"]) / 60
+
+    def ordered(self, now=None):
+        """Get (chat_id, entry, effective_priority) for every entry in matching order
+
+        The heaps are sorted in place, dropping stale items; a sorted list is
+        still a valid heap. After the first round only the entries pushed
+        since the last one are out of place, so each sort is close to linear
+        instead of a full O(n log n) sort of the lobby.
+        """
+        now = time.time() if now is None else now
+        self._heap[:] = [item for item in self._heap if self._valid(item)]
+        self._fifo[:] = [item for item in self._fifo if self._valid(item)]
+        self._heap.sort()
+        self._fifo.sort()
+        cutoff = now - MAX_WAIT_SECONDS
+        starving = list(itertools.takewhile(lambda item: item[0] < cutoff, self._fifo))
+        starving_ids = {item[2] for item in starving}
+        rest = [item for item in self._heap if item[2] not in starving_ids]
+        return [(chat_id, self.entries[chat_id], self.effective_priority(chat_id, now))
+                for _, _, chat_id in starving + rest]
+
+    def average_age(self, now=None):
+        """Get the average time in seconds the waiting users have been in the lobby, O(1)"""
+        if not self.entries:
+            return 0.0
+        now = time.time() if now is None else now
+        return now - self._joined_total / len(self.entries)
+
+    def wait_time_percentiles(self):
+        """Get wait-time percentiles in seconds of recently matched users"""
+        waits = list(self.waits)
+        return {
+            "all": percentiles([wait for _, wait in waits]),
+            "vip": percentiles([wait for user_type, wait in waits if user_type == "VIP"]),
+            "free": percentiles([wait for user_type, wait in waits if user_type != "VIP"]),
+            "samples": len(waits)
+        }
@@ -0,0 +1,164 @@
+import time
+from collections import defaultdict
+from lobby_index import LobbyIndex, bucket_key
+from log import log
+
+TIME_BUDGET_SECONDS = 2.0  # Partitions left when the budget runs out are paired greedily
+
+GENDERS = ("Male", "Female")
+PREFERENCES = ("Any", "Male", "Female")
+
+
+def _smallest_total(first, first_sums, second, second_sums, second_length, count):
+    """Get the sum of the count smallest positions in first and second[:second_length], both ascending"""
+    low, high = max(0, count - second_length), min(count, len(first))
+    while low < high:
+        taken = (low + high) // 2
+        if first[taken] < second[count - taken - 1]:
+            low = taken + 1
+        else:
+            high = taken
+    return first_sums[low] + second_sums[count - low]
+
+
+def _prefix_sums(positions):
+    sums = [0]
+    for position in positions:
+        sums.append(sums[-1] + position)
+    return sums
+
+
+def best_split(groups, deadline=None):
+    """Get (x, y, pairs) maximising the pairs of one partition, or None past the deadline
+
+    groups maps (gender, preference) to positions in priority order. Male
+    users wanting females and the first x males open to anyone pair with
+    females wanting males and the first y females open to anyone; every
+    user on the left is compatible with every user on the right. The
+    remaining males open to anyone pair among themselves and with males
+    wanting males, likewise on the female side.
+
+    Among splits with the most pairs, the one leaving the lowest-priority
+    users unpaired wins (the largest sum of unpaired positions, as every
+    split leaves the same number of users unpaired).
+    """
+    male_female, male_any, male_male, female_male, female_any, female_female = (
+        groups.get(key, []) for key in (("Male", "Female"), ("Male", "Any"), ("Male", "Male"),
+                                        ("Female", "Male"), ("Female", "Any"), ("Female", "Female")))
+    male_female_sums, male_any_sums, female_male_sums, female_any_sums = (
+        _prefix_sums(positions) for positions in (male_female, male_any, female_male, female_any))
+
+    def cross_unpaired(fixed, fixed_sums, anyone, anyone_sums, taken, other_side):
+        # The larger cross side leaves its lowest-priority users unpaired
+        total = fixed_sums[-1] + anyone_sums[taken]
+        return total - _smallest_total(fixed, fixed_sums, anyone, anyone_sums, taken, other_side)
+
+    def odd_unpaired(same, anyone, taken):
+        # An odd same-side group leaves its last user unpaired
+        return max(same[-1] if same else -1, anyone[-1] if taken < len(anyone) else -1)
+
+    best = None
+    for x in range(len(male_any) + 1):
+        if deadline is not None and time.perf_counter() >= deadline:
+            return None
+        left = len(male_female) + x
+        # Moving females into the cross group pays off until it is as big as the left side;
+        # one fewer or one more female can tie on pairs, so those are weighed too
+        fitted = min(max(left - len(female_male), 0), len(female_any))
+        for y in range(max(fitted - 1, 0), min(fitted + 1, len(female_any)) + 1):
+            right = len(female_male) + y
+            males = len(male_male) + len(male_any) - x
+            females = len(female_female) + len(female_any) - y
+            pairs = min(left, right) + males // 2 + females // 2
+            unpaired = 0
+            if left > right:
+                unpaired += cross_unpaired(male_female, male_female_sums, male_any, male_any_sums, x, right)
+            elif right > left:
+                unpaired += cross_unpaired(female_male, female_male_sums, female_any, female_any_sums, y, left)
+            if males % 2:
+                unpaired += odd_unpaired(male_male, male_any, x)
+            if females % 2:
+                unpaired += odd_unpaired(female_female, female_any, y)
+            if best is None or (pairs, unpaired) > (best[2], best[3]):
+                best = (x, y, pairs, unpaired)
+    return best[:3]
+
+
+def _pair_partition(groups, deadline=None):
+    """Pair one partition, groups maps (gender, preference) to positions in priority order
+
+    Returns None if the deadline passes first.
+    """
+    split = best_split(groups, deadline)
+    if split is None:
+        return None
+    x, y, _ = split
+    male_any = groups.get(("Male", "Any"), [])
+    female_any = groups.get(("Female", "Any"), [])
+
+    # Highest-priority users of each open group take the cross places
+    left = sorted(groups.get(("Male", "Female"), []) + male_any[:x])
+    right = sorted(groups.get(("Female", "Male"), []) + female_any[:y])
+    males = sorted(groups.get(("Male", "Male"), []) + male_any[x:])
+    females = sorted(groups.get(("Female", "Female"), []) + female_any[y:])
+
+    pairs = list(zip(left, right))
+    for same_side in (males, females):
+        pairs.extend(zip(same_side[0:len(same_side) - 1:2], same_side[1::2]))
+    return pairs
+
+
+def maximum_pairs(ordered_users, budget=None, recent=None):
+    """Pair as many users as possible, returning position pairs
+
+    Users are split into (match_org, domain) partitions that can't match
+    each other. Each partition is solved at class level with best_split(),
+    and within a class the highest-priority users are paired first.
+    Partitions with other gender or preference values, and those left when
+    the time budget runs out, are paired by the greedy engine. So are the
+    unpaired users of a partition where a pair was dropped because the two
+    users are in recent (a RecentPairs).
+
+    A round is slower than greedy's in exchange for a few more pairs
+    (benchmark.py: 492 against 484 pairs at 1000 users, at about 5-20%
+    fewer rounds per second).
+    """
+    partitions = defaultdict(lambda: defaultdict(list))
+    for position, (user_id, user_data, priority) in enumerate(ordered_users):
+        key = bucket_key(user_id, user_data)
+        if key is not None:
+            partitions[key[2:]][key[:2]].append(position)
+
+    budget = TIME_BUDGET_SECONDS if budget is None else budget
+    deadline = time.perf_counter() + budget
+
+    pairs = []
+    greedy_positions = []
+    for partition, groups in partitions.items():
+        solvable = all(gender in GENDERS and prefer in PREFERENCES for gender, prefer in groups)
+        partition_pairs = _pair_partition(groups, deadline) if solvable else None
+        if partition_pairs is not None:
+            if recent is not None:
+                allowed = [(first, second) for first, second in partition_pairs
+                           if not recent.contains(ordered_users[first][0], ordered_users[second][0])]
+                if len(allowed) < len(partition_pairs):
+                    paired = {position for pair in allowed for position in pair}
+                    greedy_positions.extend(position for positions in groups.values()
+                                            for position in positions if position not in paired)
+                partition_pairs = allowed
+            pairs.extend(partition_pairs)
+        else:
+            greedy_positions.extend(position for positions in groups.values() for position in positions)
+
+    if greedy_positions:
+        if time.perf_counter() >= deadline:
+            log(f"Maximum matching ran over its {budget}s budget, pairing {len(greedy_positions)} users greedily")
+        greedy_positions.sort()
+        subset = [ordered_users[position] for position in greedy_positions]
+        pairs.extend((greedy_positions[first], greedy_positions[second])
+                     for first, second in LobbyIndex(subset, recent).pairs())
+
+    # Commit higher-priority pairs first
+    pairs = [tuple(sorted(pair)) for pair in pairs]
+    pairs.sort()
+    return pairs
@@ -1,28 +1,34 @@
+import asyncio
 import time
-import requests
 import get_updates
+import http_client
+import metrics
 import root_json
+import scheduler
+import user_json
 from log import log
-from lobby import tot_lobby
-from match import get_matched
-from referral import process_membership_expiries
-from datetime import datetime
+from lobby import tot_lobby, reap_lobby, LOBBY_REAP_INTERVAL
+from match import get_matched, reap_idle_matches, MATCH_REAP_INTERVAL
+from referral import schedule_membership_expiries
 import os
 import re
-from send_updates import send_message
+import signal
+import match_registry
+from send_updates import send_messages
 
 BASE_URL = root_json.root_read("BASE_URL")
 TimeOut = 10
+# "threads" polls with requests and handles updates on worker threads, "asyncio" runs async_runtime,
+# "webhook" receives updates pushed by Telegram (see webhook.py) and handles them on the worker threads
+BOT_RUNTIME = os.environ.get('BOT_RUNTIME', 'threads')
 
-# Track last membership check time
-last_membership_check = datetime.now()
-last_reminder_sent = datetime.now()
-MEMBERSHIP_CHECK_INTERVAL = 3600  # Check every hour (3600 seconds)
-REMINDER_INTERVAL = 86400  # Check every day
+REMINDER_INTERVAL = 86400  # Send reminders every day
+MATCH_SWEEP_INTERVAL = 30  # Full lobby sweep as a safety net, users are matched on joining
 
 
 def send_reminder():
     results = []
+    messages = []
     for filename in os.listdir('.'):
         if filename.startswith('temp_context') and filename.endswith('.txt'):
             with open(filename, 'r') as file:
@@ -37,14 +43,15 @@ def send_reminder():
                 last_name = last_name_match.group(1) if last_name_match else ''
                 name = (first_name + ' ' + last_name).strip()
                 if chat_id and name:
-                    send_message(chat_id=chat_id, text=f"Hey {name} , We were just started to enjoy having you but "
-                                                       f"you have left us in middle\nPlease come back\nClick /start "
-                                                       f"to complete your registration")
+                    messages.append((chat_id, f"Hey {name} , We were just started to enjoy having you but "
+                                              f"you have left us in middle\nPlease come back\nClick /start "
+                                              f"to complete your registration"))
                     results.append({'filename': filename, 'chat_id': chat_id, 'name': name})
                 else:
-                    send_message(chat_id=chat_id,
-                                 text="Hi click /start to complete your registration")
+                    messages.append((chat_id, "Hi click /start to complete your registration"))
                     results.append({'filename': filename, 'chat_id': chat_id})
+    # Sent from the bulk sender thread, the scheduler moves on to its next job
+    send_messages(messages)
     return results
 
 
@@ -65,61 +72,87 @@ def set_bot_commands():
 
     data = {"commands": commands}
     try:
-        response = requests.post(url, json=data)
+        response = http_client.post(url, json=data)
         log("Commands set: " + str(response.json()))
     except Exception as er:
         log(f"Error setting commands: {er}")
 
 
-def check_interval_updates():
-    """Check and process VIP membership expires"""
-    global last_membership_check
-    global last_reminder_sent
-    current_time = datetime.now()
+def handle_sigterm(signum, frame):
+    """Save pending user changes and the match registry, then exit (systemd, docker stop)"""
+    log("Bot stopped by SIGTERM")
+    try:
+        user_json.flush_users()
+        match_registry.compact()
+        get_updates.commit_offset()
+    except Exception as e:
+        log(f"Error saving state on SIGTERM: {e}")
+    raise SystemExit(0)
 
-    # Check if enough time has passed since last check
-    time_diff_member = (current_time - last_membership_check).total_seconds()
-    time_diff_reminder = (current_time - last_reminder_sent).total_seconds()
 
-    if time_diff_member >= MEMBERSHIP_CHECK_INTERVAL:
-        try:
-            expired_count = process_membership_expiries()
-            log(f"Membership expiry check completed. Expired memberships: {expired_count}")
-            last_membership_check = current_time
-        except Exception as err:
-            log(f"Error during membership expiry check: {err}")
+def run_reminder():
+    """Send the daily registration reminder"""
+    log(f"Sent reminder to {send_reminder()}")
 
-    if time_diff_reminder >= REMINDER_INTERVAL:
-        try:
-            log(f"Sent reminder to {send_reminder()}")
-            last_reminder_sent = current_time
-        except Exception as err:
-            log(f"Error during sending reminder: {err}")
+
+def run_match_sweep():
+    """Sweep the whole lobby for matches the join-time matching missed"""
+    if tot_lobby() > 1:
+        get_matched()
+
+
+def schedule_jobs():
+    """Register the periodic jobs and start the scheduler"""
+    scheduler.register_job("send_reminder", run_reminder)
+    scheduler.register_job("match_sweep", run_match_sweep)
+    scheduler.register_job("lobby_reaper", reap_lobby)
+    scheduler.register_job("match_reaper", reap_idle_matches)
+    scheduler.register_job("log_metrics", metrics.log_metrics)
+    scheduler.schedule_every("send_reminder", REMINDER_INTERVAL)
+    scheduler.schedule_every("match_sweep", MATCH_SWEEP_INTERVAL)
+    scheduler.schedule_every("lobby_reaper", LOBBY_REAP_INTERVAL)
+    scheduler.schedule_every("match_reaper", MATCH_REAP_INTERVAL)
+    scheduler.schedule_every("log_metrics", metrics.METRICS_LOG_INTERVAL)
+    schedule_membership_expiries()
+    scheduler.start()
 
 
 if __name__ == "__main__":
     log("Bot started")
+    signal.signal(signal.SIGTERM, handle_sigterm)
 
     # Set bot commands on startup
     set_bot_commands()
     log(f"Sent reminder to {send_reminder()}")
 
-    while True:
-        try:
-            # Read and process messages
-            get_updates.read_msg(TIMEOUT=TimeOut)
-
-            # Check for matches if lobby has users
-            if tot_lobby() > 1:
-                get_matched()
+    # Run timed jobs in the background, memberships that ended while the bot was down expire right away
+    schedule_jobs()
 
-            # Periodically check for membership expires
-            check_interval_updates()
+    if BOT_RUNTIME == "asyncio":
+        import async_runtime
+        try:
+            asyncio.run(async_runtime.run(TIMEOUT=TimeOut))
+        except KeyboardInterrupt:
+            log("Bot stopped by user")
+            user_json.flush_users()
+        raise SystemExit
+
+    if BOT_RUNTIME == "webhook":
+        import webhook
+        if webhook.WEBHOOK_URL:
+            webhook.set_webhook()
+        webhook.start_server()
+    else:
+        # Long-poll in the background, handle updates here as soon as they arrive
+        get_updates.start_fetcher(TIMEOUT=TimeOut)
 
-            time.sleep(1)
+    while True:
+        try:
+            get_updates.process_pending(timeout=1)
 
         except KeyboardInterrupt:
             log("Bot stopped by user")
+            user_json.flush_users()
             break
         except Exception as e:
             log(f"Main loop error: {e}")
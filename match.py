@@ -1,94 +1,82 @@
-import json
 import os
-from send_updates import send_message
-from lobby import remove_from_lobby
+import threading
+import storage
+import match_registry
+import metrics
+import match_shards
+import recent_pairs
+from send_updates import send_messages
+from lobby import remove_pairs_from_lobby, update_lobby_entry, get_lobby_users, get_lobby_order, get_wait_time_stats, tot_lobby
+from lobby import add_lobby_listener, find_lobby_partner, get_lobby_entry
 from user_json import user_read
 from log import log
+from lobby_index import greedy_pairs, entry_domain, VIP_PRIORITY, FREE_PRIORITY
+from lobby_maximum import maximum_pairs
 from referral import check_membership_expiry, expire_vip_membership
 
 # File to store active matches
 matches_filepath = os.path.join(os.path.dirname(__file__), "Json Files", "matches.json")
 lobby_filepath = os.path.join(os.path.dirname(__file__), "Json Files", "lobby.json")
 
+# Serialises matching rounds and new-entrant matching
+_match_lock = threading.RLock()
+
+MATCH_IDLE_SECONDS = 3600  # Matches without a relayed message for this long are ended
+MATCH_REAP_INTERVAL = 300  # Seconds between idle match reaper runs
+
+# Engine used by get_matched to pair the lobby, chosen with MATCH_ENGINE
+DEFAULT_ENGINE = "greedy"
+
 def initialize_matches_file():
     """Initialize matches file if it doesn't exist"""
-    if not os.path.exists(matches_filepath):
-        os.makedirs(os.path.dirname(matches_filepath), exist_ok=True)
-        with open(matches_filepath, 'w') as f:
-            json.dump({}, f)
+    storage.get_backend().initialize("matches")
 
 def get_matches():
     """Get all current matches"""
-    initialize_matches_file()
     try:
-        with open(matches_filepath, 'r') as f:
-            return json.load(f)
+        return match_registry.all_matches()
     except:
         return {}
 
 def save_matches(matches_data):
     """Save matches to file"""
-    initialize_matches_file()
-    with open(matches_filepath, 'w') as f:
-        json.dump(matches_data, f, indent=4)
+    match_registry.replace_matches(matches_data)
 
 def check_matched(chat_id):
     """Check if user is currently matched with someone"""
-    matches = get_matches()
-    chat_id_str = str(chat_id)
-
-    # Check if user is in matches as key
-    if chat_id_str in matches:
-        return matches[chat_id_str]
-
-    # Check if user is matched as a value
-    for user_id, partner_id in matches.items():
-        if str(partner_id) == chat_id_str:
-            return user_id
-
-    return None
+    return match_registry.partner_of(chat_id)
 
 def create_match(user1_id, user2_id):
     """Create a match between two users"""
-    matches = get_matches()
-    user1_str = str(user1_id)
-    user2_str = str(user2_id)
-
-    # Add both directions for easy lookup
-    matches[user1_str] = user2_str
-    matches[user2_str] = user1_str
-
-    save_matches(matches)
+    match_registry.add_match(user1_id, user2_id)
     log(f"Match created: {user1_id} <-> {user2_id}")
 
 def unmatch(chat_id):
     """Remove user from matches"""
-    matches = get_matches()
-    chat_id_str = str(chat_id)
-    partner_id = None
+    partner_id = match_registry.remove_match(chat_id)
+    log(f"User {chat_id} unmatched from {partner_id}")
+    return partner_id
 
-    # Find and remove the match
-    if chat_id_str in matches:
-        partner_id = matches[chat_id_str]
-        del matches[chat_id_str]
+def touch_match(chat_id):
+    """Record that a user relayed a message to their partner"""
+    match_registry.touch(chat_id)
 
-        # Also remove the reverse mapping
-        if partner_id in matches:
-            del matches[partner_id]
+def reap_idle_matches(now=None):
+    """End matches without messages for MATCH_IDLE_SECONDS, returns how many were ended"""
+    idle = match_registry.idle_matches(MATCH_IDLE_SECONDS, now)
+    if not idle:
+        return 0
 
-    save_matches(matches)
-    log(f"User {chat_id} unmatched from {partner_id}")
-    return partner_id
+    removed = match_registry.remove_matches([user1_id for user1_id, user2_id in idle])
+    text = "Chat ended because of inactivity.\nUse /connect to find a new partner!"
+    send_messages([(int(user_id), text) for user1_id, partner_id in removed.items() for user_id in (user1_id, partner_id)])
+    metrics.increment("idle_matches_ended", len(removed))
+    log(f"Ended {len(removed)} idle matches")
+    return len(removed)
 
 def get_lobby_data():
     """Get current lobby data"""
-    if not os.path.exists(lobby_filepath):
-        return {}
-    try:
-        with open(lobby_filepath, 'r') as f:
-            return json.load(f)
-    except:
-        return {}
+    return get_lobby_users()
 
 def is_compatible(user1_data, user2_data, user1_id=None, user2_id=None):
     """Check if two users are compatible for matching"""
@@ -111,15 +99,9 @@ def is_compatible(user1_data, user2_data, user1_id=None, user2_id=None):
     # If both users want to match within organization, check email domains
     if user1_match_org and user2_match_org and user1_id and user2_id:
         try:
-            user1_full_data = user_read(user1_id)
-            user2_full_data = user_read(user2_id)
-
-            user1_email = user1_full_data.get("email", "")
-            user2_email = user2_full_data.get("email", "")
-
-            # Extract domains
-            user1_domain = user1_email.split("@")[1] if "@" in user1_email else None
-            user2_domain = user2_email.split("@")[1] if "@" in user2_email else None
+            # Domains are stored on lobby entries, older entries fall back to the user record
+            user1_domain = entry_domain(user1_id, user1_data)
+            user2_domain = entry_domain(user2_id, user2_data)
 
             # Check if domains match
             domains_match = user1_domain and user2_domain and user1_domain == user2_domain
@@ -147,151 +129,178 @@ def get_user_priority(user_data, user_id):
         if check_membership_expiry(user_id):
             # VIP membership expired, downgrade user
             expire_vip_membership(user_id)
-            return 1  # Free user priority
+            return FREE_PRIORITY  # Free user priority
         else:
-            return 10  # VIP user priority
-
-    return 1  # Free user priority
+            return VIP_PRIORITY  # VIP user priority
 
-def sort_users_by_priority(lobby_users):
-    """Sort lobby users by priority (VIP first, then Free)"""
-    priority_users = []
+    return FREE_PRIORITY  # Free user priority
 
-    for user_id, user_data in lobby_users:
+def refresh_lobby_priorities():
+    """Update lobby entries whose VIP status changed since they joined"""
+    for user_id, user_data in get_lobby_data().items():
         try:
             # Get user info to check VIP status
             user_info = user_read(user_id)
-            priority = get_user_priority(user_info, user_id)
-            priority_users.append((user_id, user_data, priority))
+            user_type = "VIP" if get_user_priority(user_info, user_id) == VIP_PRIORITY else "Free"
         except Exception as e:
             log(f"Error getting priority for user {user_id}: {e}")
-            # Default to free user priority if error
-            priority_users.append((user_id, user_data, 1))
+            continue
 
-    # Sort by priority (highest first)
-    priority_users.sort(key=lambda x: x[2], reverse=True)
-    return priority_users
+        if user_data.get("type", "Free") != user_type:
+            update_lobby_entry(user_id, type=user_type)
+
+def match_new_entrant(chat_id):
+    """Try to match a user who just joined the lobby with a compatible waiting user"""
+    with _match_lock:
+        # Users are not paired again with someone they were just matched with
+        partner_id = find_lobby_partner(chat_id, recent=recent_pairs.get_filter())
+        if partner_id is None:
+            return False
+
+        user1_data = get_lobby_entry(chat_id)
+        user2_data = get_lobby_entry(partner_id)
+        if user1_data is None or user2_data is None:
+            return False
+        messages = commit_match_pairs([(partner_id, chat_id, user2_data, user1_data)])
+
+    # Notify outside the lock, sends wait on the rate limiter
+    send_messages(messages)
+    return bool(messages)
+
+# Pairing engines: each takes the lobby in matching order and returns position pairs
+ENGINES = {
+    "greedy": greedy_pairs,
+    "maximum": maximum_pairs
+}
+
+def set_engine(name):
+    """Choose the pairing engine used by get_matched"""
+    global match_engine
+    if name not in ENGINES:
+        raise ValueError(f"Unknown match engine '{name}'")
+    match_engine = name
+
+match_engine = DEFAULT_ENGINE
+try:
+    set_engine(os.environ.get('MATCH_ENGINE', DEFAULT_ENGINE).lower())
+except ValueError as e:
+    log(f"{e}, using the {DEFAULT_ENGINE} match engine")
 
 def get_matched():
     """Find and create matches from lobby with VIP priority"""
-    lobby_data = get_lobby_data()
-    if len(lobby_data) < 2:
-        return
-
-    lobby_users = list(lobby_data.items())
+    with _match_lock:
+        messages = _get_matched()
 
-    # Sort users by priority (VIP users first)
-    priority_sorted_users = sort_users_by_priority(lobby_users)
+    # Notify outside the lock, sends wait on the rate limiter
+    send_messages(messages)
 
-    matched_users = []
+def _get_matched():
+    """Pair and commit a matching round, returns the notifications to send"""
+    if tot_lobby() < 2:
+        return []
 
-    # Try to find compatible pairs, prioritizing VIP users
-    for i in range(len(priority_sorted_users)):
-        if priority_sorted_users[i][0] in matched_users:
-            continue
-
-        user1_id, user1_data, user1_priority = priority_sorted_users[i]
-
-        # For VIP users, try to match with other VIP users first
-        if user1_priority > 1:  # VIP user
-            # First, try to match with other VIP users
-            for j in range(len(priority_sorted_users)):
-                if i == j or priority_sorted_users[j][0] in matched_users:
-                    continue
-
-                user2_id, user2_data, user2_priority = priority_sorted_users[j]
-
-                # Prefer VIP-VIP matches
-                if user2_priority > 1 and is_compatible(user1_data, user2_data, user1_id, user2_id):
-                    if create_match_pair(user1_id, user2_id, user1_data, user2_data):
-                        matched_users.extend([user1_id, user2_id])
-                        break
-
-            # If no VIP match found, try with Free users
-            if user1_id not in matched_users:
-                for j in range(len(priority_sorted_users)):
-                    if i == j or priority_sorted_users[j][0] in matched_users:
-                        continue
+    refresh_lobby_priorities()
 
-                    user2_id, user2_data, user2_priority = priority_sorted_users[j]
+    # Lobby in matching order: users past the maximum wait first, then by
+    # base priority plus wait-time aging
+    priority_sorted_users = get_lobby_order()
 
-                    if is_compatible(user1_data, user2_data, user1_id, user2_id):
-                        if create_match_pair(user1_id, user2_id, user1_data, user2_data):
-                            matched_users.extend([user1_id, user2_id])
-                            break
+    # Pair the lobby with the selected engine, greedy by default, split by
+    # org domain across worker processes when MATCH_WORKERS is set
+    pairs = []
+    recent = recent_pairs.get_filter()
+    for position1, position2 in match_shards.sharded_pairs(ENGINES[match_engine], priority_sorted_users, recent):
+        user1_id, user1_data, user1_priority = priority_sorted_users[position1]
+        user2_id, user2_data, user2_priority = priority_sorted_users[position2]
+        pairs.append((user1_id, user2_id, user1_data, user2_data))
 
-        else:  # Free user
-            # Try to match with any compatible user not already matched
-            for j in range(i + 1, len(priority_sorted_users)):
-                if priority_sorted_users[j][0] in matched_users:
-                    continue
-
-                user2_id, user2_data, user2_priority = priority_sorted_users[j]
-
-                if is_compatible(user1_data, user2_data, user1_id, user2_id):
-                    if create_match_pair(user1_id, user2_id, user1_data, user2_data):
-                        matched_users.extend([user1_id, user2_id])
-                        break
+    # Commit the whole round at once
+    return commit_match_pairs(pairs)
 
 def create_match_pair(user1_id, user2_id, user1_data, user2_data):
     """Create a match between two specific users"""
+    return create_match_pairs([(user1_id, user2_id, user1_data, user2_data)]) == 1
+
+def create_match_pairs(pairs):
+    """Commit pairs and notify the users, returns how many matches were created"""
+    messages = commit_match_pairs(pairs)
+    send_messages(messages)
+    return len(messages) // 2
+
+def commit_match_pairs(pairs):
+    """Commit (user1_id, user2_id, user1_data, user2_data) pairs in one batch, returns the notifications to send
+
+    Only pairs whose users are both still in the lobby are matched: they
+    leave the lobby with one storage write and go into the registry with
+    one change log append while the lobby is locked. The caller sends the
+    notifications, after releasing its own locks.
+    """
+    if not pairs:
+        return []
+
+    data = {}
+    for user1_id, user2_id, user1_data, user2_data in pairs:
+        data[str(user1_id)] = user1_data
+        data[str(user2_id)] = user2_data
     try:
-        # Create the match
-        create_match(user1_id, user2_id)
-
-        # Remove both users from lobby
-        remove_from_lobby(user1_id)
-        remove_from_lobby(user2_id)
+        matched_pairs = remove_pairs_from_lobby([(user1_id, user2_id) for user1_id, user2_id, _, _ in pairs],
+                                                commit=match_registry.add_matches)
+    except Exception as e:
+        log(f"Error committing {len(pairs)} matches: {e}")
+        return []
+    if len(matched_pairs) < len(pairs):
+        log(f"Skipped {len(pairs) - len(matched_pairs)} pairs with users no longer in the lobby")
+    recent_pairs.record_pairs(matched_pairs)
+
+    messages = []
+    for user1_id, user2_id in matched_pairs:
+        user1_data, user2_data = data[user1_id], data[user2_id]
+        log(f"Match created: {user1_id} <-> {user2_id}")
+        messages.extend(match_messages(user1_id, user2_id, user1_data, user2_data))
+        log(f"Successfully matched {user1_id} ({user1_data.get('type', 'Free')}) with {user2_id} ({user2_data.get('type', 'Free')})")
+    return messages
 
+def match_messages(user1_id, user2_id, user1_data, user2_data):
+    """Get the (chat_id, text) notifications for a new match"""
+    try:
         # Get user names for messages
-        try:
-            user1_info = user_read(user1_id)
-            user2_info = user_read(user2_id)
-
-            user1_type = user1_info.get("type", "Free")
-            user2_type = user2_info.get("type", "Free")
+        user1_info = user_read(user1_id)
+        user2_info = user_read(user2_id)
 
-            user1_gender_emoji = "🧒" if user1_info["gender"] == "Female" else "👦"
-            user2_gender_emoji = "🧒" if user2_info["gender"] == "Female" else "👦"
+        user1_type = user1_info.get("type", "Free")
+        user2_type = user2_info.get("type", "Free")
 
-            # Create match messages with VIP indicators
-            user1_message = f"🎉 Match found! You're now connected with a {user2_info['gender'].lower()}. {user2_gender_emoji}"
-            user2_message = f"🎉 Match found! You're now connected with a {user1_info['gender'].lower()}. {user1_gender_emoji}"
+        user1_gender_emoji = "🧒" if user1_info["gender"] == "Female" else "👦"
+        user2_gender_emoji = "🧒" if user2_info["gender"] == "Female" else "👦"
 
-            # Add VIP status indicators
-            if user2_type == "VIP":
-                user1_message += "\n✨ Your partner is a VIP member!"
-            if user1_type == "VIP":
-                user2_message += "\n✨ Your partner is a VIP member!"
+        # Create match messages with VIP indicators
+        user1_message = f"🎉 Match found! You're now connected with a {user2_info['gender'].lower()}. {user2_gender_emoji}"
+        user2_message = f"🎉 Match found! You're now connected with a {user1_info['gender'].lower()}. {user1_gender_emoji}"
 
-            # Add organization matching indicators
-            if user1_data.get("match_org") and user2_data.get("match_org"):
-                user1_email = user1_info.get("email", "")
-                user2_email = user2_info.get("email", "")
-                if user1_email and user2_email:
-                    domain = user1_email.split("@")[1]
-                    user1_message += f"\n🏛️ You're matched with someone from @{domain}!"
-                    user2_message += f"\n🏛️ You're matched with someone from @{domain}!"
+        # Add VIP status indicators
+        if user2_type == "VIP":
+            user1_message += "\n✨ Your partner is a VIP member!"
+        if user1_type == "VIP":
+            user2_message += "\n✨ Your partner is a VIP member!"
 
-            user1_message += "\n\nStart chatting! Use /next to find a new partner or /disconnect to end chat."
-            user2_message += "\n\nStart chatting! Use /next to find a new partner or /disconnect to end chat."
+        # Add organization matching indicators
+        if user1_data.get("match_org") and user2_data.get("match_org"):
+            user1_email = user1_info.get("email", "")
+            user2_email = user2_info.get("email", "")
+            if user1_email and user2_email:
+                domain = user1_email.split("@")[1]
+                user1_message += f"\n🏛️ You're matched with someone from @{domain}!"
+                user2_message += f"\n🏛️ You're matched with someone from @{domain}!"
 
-            # Notify both users
-            send_message(chat_id=int(user1_id), text=user1_message)
-            send_message(chat_id=int(user2_id), text=user2_message)
-
-        except Exception as e:
-            log(f"Error getting user info for match notification: {e}")
-            # Send generic messages if user info fails
-            send_message(chat_id=int(user1_id), text="🎉 Match found! Start chatting!")
-            send_message(chat_id=int(user2_id), text="🎉 Match found! Start chatting!")
+        user1_message += "\n\nStart chatting! Use /next to find a new partner or /disconnect to end chat."
+        user2_message += "\n\nStart chatting! Use /next to find a new partner or /disconnect to end chat."
 
-        log(f"Successfully matched {user1_id} ({user1_data.get('type', 'Free')}) with {user2_id} ({user2_data.get('type', 'Free')})")
-        return True
+        return [(int(user1_id), user1_message), (int(user2_id), user2_message)]
 
     except Exception as e:
-        log(f"Error creating match between {user1_id} and {user2_id}: {e}")
-        return False
+        log(f"Error getting user info for match notification: {e}")
+        # Send generic messages if user info fails
+        return [(int(user1_id), "🎉 Match found! Start chatting!"), (int(user2_id), "🎉 Match found! Start chatting!")]
 
 def get_lobby_stats():
     """Get lobby statistics including VIP/Free breakdown"""
@@ -315,8 +324,16 @@ def get_lobby_stats():
             else:
                 stats["free_users"] += 1
 
+        # Wait-time percentiles (seconds) of recently matched users
+        stats["wait_times"] = get_wait_time_stats()
+
         return stats
 
     except Exception as e:
         log(f"Error getting lobby stats: {e}")
-        return {"total_users": 0, "vip_users": 0, "free_users": 0}
\ No newline at end of file
+        return {"total_users": 0, "vip_users": 0, "free_users": 0}
+
+metrics.register_gauge("active_matches", match_registry.count_matches)
+
+# Match users as soon as they join the lobby; get_matched() remains the periodic full sweep
+add_lobby_listener(match_new_entrant)
\ No newline at end of file
@@ -0,0 +1,202 @@
+import atexit
+import os
+import threading
+import time
+from collections import OrderedDict
+import storage
+from log import log
+
+# Append-only change log of match additions/removals since the last compaction
+log_filepath = os.path.join(os.path.dirname(__file__), "Json Files", "matches.log")
+
+COMPACT_EVERY = 1000  # Change log entries that trigger a compaction into the matches table
+
+# chat_id -> partner_id, both directions stored
+_partners = None
+_log_file = None
+_log_entries = 0
+_lock = threading.RLock()
+# (user1_id, user2_id) -> last relayed message time, least recently active first
+_activity = OrderedDict()
+
+
+def _load():
+    """Load matches from storage and replay the change log on first use"""
+    global _partners, _log_file, _log_entries
+    with _lock:
+        if _partners is not None:
+            return _partners
+
+        try:
+            partners = storage.get_backend().all("matches")
+        except Exception as e:
+            log(f"Error loading matches: {e}")
+            partners = {}
+
+        entries = 0
+        if os.path.exists(log_filepath):
+            with open(log_filepath, 'r') as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) != 3:
+                        continue
+                    op, user1, user2 = parts
+                    if op == "+":
+                        partners[user1] = user2
+                        partners[user2] = user1
+                    elif op == "-":
+                        partners.pop(user1, None)
+                        partners.pop(user2, None)
+                    entries += 1
+
+        # Activity isn't persisted, matches loaded at startup count as active now
+        now = time.time()
+        for user_id, partner_id in partners.items():
+            if user_id < partner_id:
+                _activity[(user_id, partner_id)] = now
+
+        _partners = partners
+        _log_entries = entries
+        _log_file = open(log_filepath, 'a')
+        atexit.register(compact)
+        return _partners
+
+
+def _append(lines):
+    """Append change log lines and compact when the log grows too long"""
+    global _log_entries
+    _log_file.write("".join(lines))
+    _log_file.flush()
+    _log_entries += len(lines)
+    if _log_entries >= COMPACT_EVERY:
+        compact()
+
+
+def compact():
+    """Write the current matches to storage and truncate the change log"""
+    global _log_entries
+    with _lock:
+        if _partners is None or _log_entries == 0:
+            return
+        try:
+            storage.get_backend().replace_all("matches", _partners)
+            _log_file.seek(0)
+            _log_file.truncate()
+            _log_entries = 0
+            log(f"Compacted match log, {len(_partners) // 2} active matches")
+        except Exception as e:
+            log(f"Error compacting match log: {e}")
+
+
+def _pair_key(user1_id, user2_id):
+    return (user1_id, user2_id) if user1_id < user2_id else (user2_id, user1_id)
+
+
+def partner_of(chat_id):
+    """Get the partner of a user, or None if they aren't matched"""
+    return _load().get(str(chat_id))
+
+
+def is_matched(chat_id):
+    """Check if a user is currently matched"""
+    return str(chat_id) in _load()
+
+
+def add_match(user1_id, user2_id):
+    """Record a match between two users"""
+    add_matches([(user1_id, user2_id)])
+
+
+def add_matches(pairs):
+    """Record several matches with one change log append"""
+    partners = _load()
+    with _lock:
+        lines = []
+        for user1_id, user2_id in pairs:
+            user1_str = str(user1_id)
+            user2_str = str(user2_id)
+            partners[user1_str] = user2_str
+            partners[user2_str] = user1_str
+            key = _pair_key(user1_str, user2_str)
+            _activity[key] = time.time()
+            _activity.move_to_end(key)
+            lines.append(f"+ {user1_str} {user2_str}\n")
+        if lines:
+            _append(lines)
+
+
+def remove_match(chat_id):
+    """Remove a user's match, returns the former partner or None"""
+    return remove_matches([chat_id]).get(str(chat_id))
+
+
+def remove_matches(chat_ids):
+    """Remove several users' matches with one change log append, returns {chat_id: former partner}"""
+    partners = _load()
+    with _lock:
+        removed = {}
+        lines = []
+        for chat_id in chat_ids:
+            chat_id_str = str(chat_id)
+            partner_id = partners.pop(chat_id_str, None)
+            if partner_id is None:
+                continue
+            partners.pop(partner_id, None)
+            _activity.pop(_pair_key(chat_id_str, partner_id), None)
+            removed[chat_id_str] = partner_id
+            lines.append(f"- {chat_id_str} {partner_id}\n")
+        if lines:
+            _append(lines)
+        return removed
+
+
+def touch(chat_id):
+    """Record activity in a user's match, O(1)"""
+    partners = _load()
+    with _lock:
+        partner_id = partners.get(str(chat_id))
+        if partner_id is not None:
+            key = _pair_key(str(chat_id), partner_id)
+            _activity[key] = time.time()
+            _activity.move_to_end(key)
+
+
+def idle_matches(idle_seconds, now=None):
+    """Get (user1_id, user2_id) of matches without activity for idle_seconds, most idle first"""
+    now = time.time() if now is None else now
+    _load()
+    with _lock:
+        idle = []
+        for key, last_active in _activity.items():
+            if now - last_active < idle_seconds:
+                break
+            idle.append(key)
+        return idle
+
+
+def all_matches():
+    """Get a copy of all matches (both directions)"""
+    partners = _load()
+    with _lock:
+        return dict(partners)
+
+
+def replace_matches(matches_data):
+    """Replace all matches and compact immediately"""
+    global _log_entries
+    partners = _load()
+    with _lock:
+        partners.clear()
+        partners.update({str(user_id): str(partner_id) for user_id, partner_id in matches_data.items()})
+        now = time.time()
+        _activity.clear()
+        for user_id, partner_id in partners.items():
+            if user_id < partner_id:
+                _activity[(user_id, partner_id)] = now
+        _log_entries += 1
+        compact()
+
+
+def count_matches():
+    """Get the number of active matches"""
+    return len(_load()) // 2
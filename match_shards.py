@@ -0,0 +1,110 @@
+import atexit
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from lobby_index import bucket_key
+from log import log
+
+# Worker processes used to pair the lobby; 0 or 1 pairs it in-process
+MATCH_WORKERS = int(os.environ.get('MATCH_WORKERS', '0'))
+MIN_SHARDED_LOBBY = 2000  # Smaller lobbies aren't worth sending to the workers
+
+# Entry fields the pairing engines need, the rest stay in the coordinator
+SHARD_FIELDS = ("gender", "prefer", "type", "match_org", "domain", "joined_at")
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Get the process pool, started on first use"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # Spawned workers don't inherit the bot's threads and open files
+            _executor = ProcessPoolExecutor(max_workers=MATCH_WORKERS,
+                                            mp_context=multiprocessing.get_context("spawn"))
+            atexit.register(shutdown)
+        return _executor
+
+
+def shutdown():
+    """Stop the worker processes"""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+
+def partition_lobby(ordered_users):
+    """Group lobby positions by (match_org, domain), the open category being one partition
+
+    Users of different partitions can never be matched, so each partition
+    can be paired on its own. Users without a bucket are left out.
+    """
+    partitions = {}
+    for position, (user_id, user_data, priority) in enumerate(ordered_users):
+        key = bucket_key(user_id, user_data)
+        if key is not None:
+            partitions.setdefault(key[2:], []).append(position)
+    return partitions
+
+
+def plan_shards(partitions, shards):
+    """Spread partitions over shards, largest first onto the least loaded shard"""
+    plan = [[] for _ in range(shards)]
+    for positions in sorted(partitions.values(), key=len, reverse=True):
+        min(plan, key=len).extend(positions)
+    return [sorted(positions) for positions in plan if positions]
+
+
+def _pair_shard(engine, users, recent):
+    """Worker entry point: pair one shard with the engine"""
+    return engine(users, recent=recent)
+
+
+def sharded_pairs(engine, ordered_users, recent=None):
+    """Pair the lobby across the worker processes, returning position pairs
+
+    Each worker gets the users of whole partitions with only the fields
+    the engines need, org domains already resolved so workers never read
+    the user store. The recent pairs filter is shared memory the workers
+    read in place, so only its name is sent. The pairs come back as
+    positions in ordered_users. Falls back to pairing in-process if the
+    pool fails.
+    """
+    if MATCH_WORKERS < 2 or len(ordered_users) < MIN_SHARDED_LOBBY:
+        return engine(ordered_users, recent=recent)
+
+    partitions = partition_lobby(ordered_users)
+    domains = {position: domain for (match_org, domain), positions in partitions.items() if match_org
+               for position in positions}
+    shards = plan_shards(partitions, MATCH_WORKERS)
+    try:
+        if recent is not None:
+            recent.share()
+        executor = get_executor()
+        futures = []
+        for positions in shards:
+            users = []
+            for position in positions:
+                user_id, user_data, priority = ordered_users[position]
+                entry = {field: user_data[field] for field in SHARD_FIELDS if field in user_data}
+                if position in domains:
+                    entry["domain"] = domains[position]
+                users.append((user_id, entry, priority))
+            futures.append(executor.submit(_pair_shard, engine, users, recent))
+
+        pairs = []
+        for positions, future in zip(shards, futures):
+            pairs.extend((positions[first], positions[second]) for first, second in future.result())
+    except Exception as e:
+        log(f"Error in sharded matching, pairing in-process: {e}")
+        shutdown()
+        return engine(ordered_users, recent=recent)
+
+    # Commit higher-priority pairs first
+    pairs.sort(key=min)
+    return pairs
@@ -0,0 +1,40 @@
+import threading
+from log import log
+
+METRICS_LOG_INTERVAL = 300  # Seconds between metric snapshots in the log
+
+# name -> callable returning the current value
+_gauges = {}
+# name -> running total
+_counters = {}
+_lock = threading.Lock()
+
+
+def register_gauge(name, func):
+    """Register a function reporting a current value, read on every snapshot"""
+    with _lock:
+        _gauges[name] = func
+
+
+def increment(name, amount=1):
+    """Add to a counter"""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def snapshot():
+    """Get the current value of every counter and gauge"""
+    with _lock:
+        values = dict(_counters)
+        gauges = dict(_gauges)
+    for name, func in gauges.items():
+        try:
+            values[name] = func()
+        except Exception as e:
+            log(f"Error reading metric {name}: {e}")
+    return dict(sorted(values.items()))
+
+
+def log_metrics():
+    """Write a metric snapshot to the log"""
+    log("Metrics: " + ", ".join(f"{name}={value}" for name, value in snapshot().items()))
@@ -0,0 +1,131 @@
+import json
+import random
+import threading
+import time
+from collections import OrderedDict
+import metrics
+
+GLOBAL_RATE = 30  # Messages per second across all chats, Telegram's broadcast limit
+GLOBAL_BURST = 30
+CHAT_RATE = 1  # Messages per second to one chat
+CHAT_BURST = 3
+MAX_RETRIES = 3  # Retries of a call answered with 429 or 5xx
+MAX_RETRY_WAIT = 60  # Calls told to wait longer than this are given up
+MAX_BLOCKING_WAIT = 5  # Longest a sending thread waits out a chat's 429, longer ones fail fast
+BACKOFF_BASE = 0.5  # Seconds, doubled on every 5xx retry
+BACKOFF_MAX = 10
+MAX_CHAT_BUCKETS = 10000  # Least recently used buckets are dropped past this many chats
+
+
+class RateLimited(Exception):
+    """A chat is held by a 429 for longer than the caller can wait"""
+
+
+class TokenBucket:
+    """Allows rate calls per second with bursts of up to burst calls"""
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def wait_time(self, now):
+        """Seconds until a token is available, 0 if one is"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+_global = TokenBucket(GLOBAL_RATE, GLOBAL_BURST, time.monotonic())
+_chats = OrderedDict()  # chat_id -> TokenBucket, least recently used first
+_paused_until = {}  # chat_id -> monotonic time set by a 429
+_relays_ready = 0  # Relay callers only waiting on the global bucket, bulk callers let them go first
+_condition = threading.Condition()
+
+
+def _chat_wait(chat_id, now):
+    """Seconds until the chat may be sent to, ignoring the global limit"""
+    wait = _paused_until.get(chat_id, 0) - now
+    if chat_id is not None:
+        bucket = _chats.get(chat_id)
+        if bucket is None:
+            if len(_chats) >= MAX_CHAT_BUCKETS:
+                _chats.popitem(last=False)
+            bucket = _chats[chat_id] = TokenBucket(CHAT_RATE, CHAT_BURST, now)
+        else:
+            _chats.move_to_end(chat_id)
+        wait = max(wait, bucket.wait_time(now))
+    return max(wait, 0)
+
+
+def reserve(chat_id=None, bulk=False):
+    """Take a token for a call to chat_id if one is free, otherwise return the seconds to wait"""
+    chat_id = str(chat_id) if chat_id is not None else None
+    with _condition:
+        now = time.monotonic()
+        wait = max(_chat_wait(chat_id, now), _global.wait_time(now))
+        if bulk and _relays_ready and wait <= 0:
+            wait = 1 / GLOBAL_RATE
+        if wait > 0:
+            return wait
+        _global.tokens -= 1
+        if chat_id is not None:
+            _chats[chat_id].tokens -= 1
+        _condition.notify_all()
+        return 0
+
+
+def acquire(chat_id=None, bulk=False, max_wait=None):
+    """Block until a call to chat_id is within the global and per-chat limits
+
+    Bulk calls (match notifications, reminders) only take a global token
+    when no relay call could use it. Raises RateLimited if the chat is
+    paused by a 429 for longer than max_wait seconds.
+    """
+    global _relays_ready
+    chat_key = str(chat_id) if chat_id is not None else None
+    counted = False
+    with _condition:
+        try:
+            while True:
+                paused = _paused_until.get(chat_key, 0) - time.monotonic()
+                if max_wait is not None and paused > max_wait:
+                    raise RateLimited(f"chat {chat_id} is rate limited for {paused:.0f}s")
+                wait = reserve(chat_id, bulk)
+                if not wait:
+                    return
+                if not bulk:
+                    ready = _chat_wait(chat_key, time.monotonic()) <= 0
+                    if ready != counted:
+                        _relays_ready += 1 if ready else -1
+                        counted = ready
+                _condition.wait(wait)
+        finally:
+            if counted:
+                _relays_ready -= 1
+                _condition.notify_all()
+
+
+def pause(chat_id, seconds):
+    """Hold calls to chat_id after a 429 on a message to it"""
+    chat_id = str(chat_id)
+    with _condition:
+        now = time.monotonic()
+        for key in [key for key, until in _paused_until.items() if until <= now]:
+            del _paused_until[key]
+        _paused_until[chat_id] = max(_paused_until.get(chat_id, 0), now + seconds)
+    metrics.increment("telegram_rate_limited")
+
+
+def retry_after(body):
+    """Get the seconds a 429 response body asks to wait"""
+    try:
+        return float(json.loads(body)["parameters"]["retry_after"])
+    except (ValueError, KeyError, TypeError):
+        return 1.0
+
+
+def backoff_delay(attempt):
+    """Jittered exponential backoff before retrying a 5xx"""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
@@ -0,0 +1,163 @@
+import atexit
+import hashlib
+import math
+import threading
+import time
+from multiprocessing import shared_memory
+import metrics
+
+PAIRS_PER_GENERATION = 1000000  # Pairs recorded before the filter rotates
+GENERATION_SECONDS = 3600  # The filter also rotates this often, so pairs are kept 1-2 generations
+FALSE_POSITIVE_RATE = 0.01  # Share of never-paired users wrongly treated as recent partners
+
+
+class RecentPairs:
+    """Rotating Bloom filter of recently paired users
+
+    Two generations of fixed size: pairs are added to the current one and
+    looked up in both, and rotating drops the older one. Memory stays the
+    same however many pairs are recorded. Lookups can give false positives
+    at about FALSE_POSITIVE_RATE, never false negatives.
+
+    Writers hold the module lock. Lookups don't: rotating swaps both
+    generations in one assignment, so a lookup sees either the old pair of
+    generations or the new one, never half of each.
+
+    share() moves the generations into shared memory for the matching
+    worker processes; a shared filter pickles as the name of its block.
+    """
+
+    def __init__(self, capacity=PAIRS_PER_GENERATION, error_rate=FALSE_POSITIVE_RATE):
+        self.capacity = capacity
+        self.bits = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        # (current, previous, previous_count), replaced as a whole on rotate
+        self.generations = (bytearray((self.bits + 7) // 8), bytearray((self.bits + 7) // 8), 0)
+        self.count = 0
+        self.started = time.time()
+        self._shared = None  # SharedMemory holding both generations once shared
+        self._current_half = 0  # Half of the shared block that is the current generation
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        if self._shared is not None:
+            state["generations"] = self.generations[2]
+            state["_shared"] = self._shared.name
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if isinstance(self._shared, str):
+            self._shared = _attach(self._shared)
+            self.generations = (self._half(self._current_half), self._half(1 - self._current_half), self.generations)
+
+    def _half(self, index):
+        size = (self.bits + 7) // 8
+        return self._shared.buf[index * size:(index + 1) * size]
+
+    def share(self):
+        """Move the generations into shared memory, so worker processes read them without a copy"""
+        if self._shared is not None:
+            return
+        current, previous, previous_count = self.generations
+        block = shared_memory.SharedMemory(create=True, size=len(current) + len(previous))
+        atexit.register(block.unlink)
+        self._shared = block
+        self._half(0)[:] = current
+        self._half(1)[:] = previous
+        self._current_half = 0
+        self.generations = (self._half(0), self._half(1), previous_count)
+
+    def _positions(self, user1_id, user2_id):
+        user1_id, user2_id = str(user1_id), str(user2_id)
+        key = f"{user1_id}:{user2_id}" if user1_id < user2_id else f"{user2_id}:{user1_id}"
+        digest = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=16).digest(), "little")
+        first = digest & 0xFFFFFFFFFFFFFFFF
+        second = (digest >> 64) | 1
+        bits = self.bits
+        return [(first + number * second) % bits for number in range(self.hashes)]
+
+    def add(self, user1_id, user2_id):
+        """Record that two users were paired"""
+        if self.count >= self.capacity:
+            self.rotate()
+        current = self.generations[0]
+        for position in self._positions(user1_id, user2_id):
+            current[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def contains(self, user1_id, user2_id):
+        """Check if two users were paired recently, O(1)"""
+        # Count is read before the generations: a rotate in between carries it into previous_count
+        count = self.count
+        current, previous, previous_count = self.generations
+        if count == 0 and previous_count == 0:
+            return False
+        positions = self._positions(user1_id, user2_id)
+        for generation in (current, previous):
+            for position in positions:
+                if not generation[position >> 3] & (1 << (position & 7)):
+                    break
+            else:
+                return True
+        return False
+
+    def rotate(self):
+        """Start a new generation, forgetting the oldest one"""
+        current, previous, _ = self.generations
+        if self._shared is not None:
+            # The oldest half of the block is cleared and reused; a lookup reading it meanwhile
+            # can only miss pairs this rotation forgets anyway
+            previous[:] = bytes(len(previous))
+            self._current_half = 1 - self._current_half
+            fresh = previous
+        else:
+            fresh = bytearray(len(current))
+        self.generations = (fresh, current, self.count)
+        self.count = 0
+        self.started = time.time()
+
+    def memory_bytes(self):
+        """Get the size of both generations in bytes"""
+        return len(self.generations[0]) + len(self.generations[1])
+
+
+_filter = None
+_lock = threading.Lock()
+_attached = {}  # Shared blocks opened by this process, by name
+
+
+def _attach(name):
+    """Open a shared filter block, once per process"""
+    block = _attached.get(name)
+    if block is None:
+        block = _attached[name] = shared_memory.SharedMemory(name=name)
+    return block
+
+
+def get_filter():
+    """Get the process-wide filter, rotated once its generation is old enough"""
+    global _filter
+    with _lock:
+        if _filter is None:
+            _filter = RecentPairs()
+        elif time.time() - _filter.started >= GENERATION_SECONDS:
+            _filter.rotate()
+        return _filter
+
+
+def record_pairs(pairs):
+    """Record (user1_id, user2_id) pairs that were just matched"""
+    recent = get_filter()
+    with _lock:
+        for user1_id, user2_id in pairs:
+            recent.add(user1_id, user2_id)
+
+
+def recently_paired(user1_id, user2_id):
+    """Check if two users were paired recently"""
+    return get_filter().contains(user1_id, user2_id)
+
+
+metrics.register_gauge("recent_pairs_memory_bytes", lambda: get_filter().memory_bytes())
+metrics.register_gauge("recent_pairs_generation_count", lambda: get_filter().count)
@@ -1,27 +1,99 @@
-import json
+import heapq
 import os
+import threading
+import time
+import scheduler
+import storage
 from datetime import datetime, timedelta
 from log import log
-from user_json import user_read, user_read_untagged, makeVIP
+from user_json import user_read, user_exists, update_users, makeVIP
 from send_updates import send_message
 
 # File paths for referral data
 referrals_filepath = os.path.join(os.path.dirname(__file__), "Json Files", "referrals.json")
 memberships_filepath = os.path.join(os.path.dirname(__file__), "Json Files", "memberships.json")
 
+# In-memory VIP expiry index: chat_id -> expiry epoch, plus a min-heap of
+# (expiry epoch, chat_id) with lazily dropped stale items
+_expiries = None
+_expiry_heap = []
+_expiry_lock = threading.RLock()
+
+MEMBERSHIP_RETRY_DELAY = 60  # Seconds before retrying expiries that failed (e.g. storage locked)
+
 def initialize_referral_file():
     """Initialize referral file if it doesn't exist"""
-    if not os.path.exists(referrals_filepath):
-        os.makedirs(os.path.dirname(referrals_filepath), exist_ok=True)
-        with open(referrals_filepath, 'w') as f:
-            json.dump({}, f)
+    storage.get_backend().initialize("referrals")
 
 def initialize_membership_file():
     """Initialize membership file if it doesn't exist"""
-    if not os.path.exists(memberships_filepath):
-        os.makedirs(os.path.dirname(memberships_filepath), exist_ok=True)
-        with open(memberships_filepath, 'w') as f:
-            json.dump({}, f)
+    storage.get_backend().initialize("memberships")
+
+def _expiry_timestamp(membership_info):
+    """Convert a membership's expiry date to an epoch timestamp"""
+    return datetime.strptime(membership_info["expiry_date"], "%Y-%m-%d %H:%M:%S").timestamp()
+
+def _load_expiries():
+    """Build the expiry index from stored memberships on first use"""
+    global _expiries, _expiry_heap
+    with _expiry_lock:
+        if _expiries is None:
+            expiries = {}
+            for chat_id, membership_info in get_membership_data().items():
+                try:
+                    expiries[chat_id] = _expiry_timestamp(membership_info)
+                except Exception as e:
+                    log(f"Error reading membership expiry for {chat_id}: {e}")
+            _expiry_heap = [(expiry, chat_id) for chat_id, expiry in expiries.items()]
+            heapq.heapify(_expiry_heap)
+            _expiries = expiries
+        return _expiries
+
+def _set_expiry(chat_id, expiry):
+    """Add or move a membership in the expiry index"""
+    global _expiry_heap
+    with _expiry_lock:
+        expiries = _load_expiries()
+        expiries[str(chat_id)] = expiry
+        heapq.heappush(_expiry_heap, (expiry, str(chat_id)))
+        if len(_expiry_heap) > 2 * len(expiries) + 64:
+            _expiry_heap = [(expiry, chat_id) for chat_id, expiry in expiries.items()]
+            heapq.heapify(_expiry_heap)
+
+def _clear_expiry(chat_id):
+    """Remove a membership from the expiry index"""
+    with _expiry_lock:
+        _load_expiries().pop(str(chat_id), None)
+
+def next_membership_expiry():
+    """Get (chat_id, expiry epoch) of the membership expiring next, or None"""
+    with _expiry_lock:
+        expiries = _load_expiries()
+        while _expiry_heap and expiries.get(_expiry_heap[0][1]) != _expiry_heap[0][0]:
+            heapq.heappop(_expiry_heap)
+        if not _expiry_heap:
+            return None
+        expiry, chat_id = _expiry_heap[0]
+        return chat_id, expiry
+
+def due_membership_expiries(now=None):
+    """Get chat ids of memberships that have expired, earliest first"""
+    now = time.time() if now is None else now
+    with _expiry_lock:
+        expiries = _load_expiries()
+        # Walk the heap from the root; a subtree is only entered if its root
+        # is due, so the cost is proportional to the number of due items
+        due = []
+        stack = [0] if _expiry_heap else []
+        while stack:
+            position = stack.pop()
+            expiry, chat_id = _expiry_heap[position]
+            if expiry > now:
+                continue
+            if expiries.get(chat_id) == expiry:
+                due.append((expiry, chat_id))
+            stack.extend(child for child in (2 * position + 1, 2 * position + 2) if child < len(_expiry_heap))
+        return [chat_id for expiry, chat_id in sorted(due)]
 
 def generate_referral_code(chat_id):
     """Generate a unique referral code for a user"""
@@ -47,46 +119,41 @@ def create_referral_link(chat_id, bot_username):
 
 def get_referral_data():
     """Get all referral data"""
-    initialize_referral_file()
     try:
-        with open(referrals_filepath, 'r') as f:
-            return json.load(f)
+        return storage.get_backend().all("referrals")
     except:
         return {}
 
 def save_referral_data(data):
     """Save referral data to file"""
-    initialize_referral_file()
-    with open(referrals_filepath, 'w') as f:
-        json.dump(data, f, indent=4)
+    storage.get_backend().replace_all("referrals", data)
 
 def add_referral(referrer_id, referred_id):
     """Add a new referral relationship"""
     try:
-        referral_data = get_referral_data()
+        backend = storage.get_backend()
 
         # Initialize referrer's data if doesn't exist
-        if str(referrer_id) not in referral_data:
-            referral_data[str(referrer_id)] = {
-                "referrals": [],
-                "total_referrals": 0,
-                "vip_earned": False,
-                "last_referral": None
-            }
+        referrer_data = backend.get("referrals", referrer_id) or {
+            "referrals": [],
+            "total_referrals": 0,
+            "vip_earned": False,
+            "last_referral": None
+        }
 
         # Check if this referral already exists
-        if str(referred_id) not in referral_data[str(referrer_id)]["referrals"]:
-            referral_data[str(referrer_id)]["referrals"].append(str(referred_id))
-            referral_data[str(referrer_id)]["total_referrals"] += 1
-            referral_data[str(referrer_id)]["last_referral"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if str(referred_id) not in referrer_data["referrals"]:
+            referrer_data["referrals"].append(str(referred_id))
+            referrer_data["total_referrals"] += 1
+            referrer_data["last_referral"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-            save_referral_data(referral_data)
+            backend.put("referrals", referrer_id, referrer_data)
 
             # Check if user qualifies for VIP (5 referrals)
-            if referral_data[str(referrer_id)]["total_referrals"] >= 5 and not referral_data[str(referrer_id)]["vip_earned"]:
+            if referrer_data["total_referrals"] >= 5 and not referrer_data["vip_earned"]:
                 grant_vip_membership(referrer_id)
-                referral_data[str(referrer_id)]["vip_earned"] = True
-                save_referral_data(referral_data)
+                referrer_data["vip_earned"] = True
+                backend.put("referrals", referrer_id, referrer_data)
 
             log(f"Referral added: {referrer_id} referred {referred_id}")
             return True
@@ -101,9 +168,9 @@ def add_referral(referrer_id, referred_id):
 def get_user_referrals(chat_id):
     """Get referral count for a specific user"""
     try:
-        referral_data = get_referral_data()
-        if str(chat_id) in referral_data:
-            return referral_data[str(chat_id)]["total_referrals"]
+        referrer_data = storage.get_backend().get("referrals", chat_id)
+        if referrer_data:
+            return referrer_data["total_referrals"]
         return 0
     except Exception as e:
         log(f"Error getting referrals for {chat_id}: {e}")
@@ -116,18 +183,23 @@ def grant_vip_membership(chat_id, days=30):
         makeVIP(chat_id)
 
         # Add membership expiration tracking
-        membership_data = get_membership_data()
         expiry_date = datetime.now() + timedelta(days=days)
 
-        membership_data[str(chat_id)] = {
+        membership_info = {
             "type": "VIP",
             "granted_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
             "expiry_date": expiry_date.strftime("%Y-%m-%d %H:%M:%S"),
             "days": days,
             "reason": "referral_reward"
         }
+        storage.get_backend().put("memberships", chat_id, membership_info)
+        expiry = _expiry_timestamp(membership_info)
+        _set_expiry(chat_id, expiry)
 
-        save_membership_data(membership_data)
+        # Bring the expiry job forward if this membership ends first
+        scheduled = scheduler.due_time("membership_expiry")
+        if scheduled is None or expiry < scheduled:
+            scheduler.schedule_at(expiry, "membership_expiry")
 
         # Notify user
         send_message(
@@ -144,26 +216,25 @@ def grant_vip_membership(chat_id, days=30):
 
 def get_membership_data():
     """Get all membership data"""
-    initialize_membership_file()
     try:
-        with open(memberships_filepath, 'r') as f:
-            return json.load(f)
+        return storage.get_backend().all("memberships")
     except:
         return {}
 
 def save_membership_data(data):
     """Save membership data to file"""
-    initialize_membership_file()
-    with open(memberships_filepath, 'w') as f:
-        json.dump(data, f, indent=4)
+    global _expiries
+    storage.get_backend().replace_all("memberships", data)
+    with _expiry_lock:
+        _expiries = None  # Rebuilt from storage on next use
+    schedule_membership_expiries()
 
 def check_membership_expiry(chat_id):
     """Check if user's VIP membership has expired"""
     try:
-        membership_data = get_membership_data()
-        if str(chat_id) in membership_data:
-            expiry_date = datetime.strptime(membership_data[str(chat_id)]["expiry_date"], "%Y-%m-%d %H:%M:%S")
-            if datetime.now() > expiry_date:
+        expiry = _load_expiries().get(str(chat_id))
+        if expiry is not None:
+            if time.time() > expiry:
                 return True  # Expired
             return False  # Still valid
         return True  # No membership record = expired
@@ -173,51 +244,43 @@ def check_membership_expiry(chat_id):
 
 def expire_vip_membership(chat_id):
     """Expire VIP membership and downgrade user to Free"""
-    try:
-        # Get user data
-        users = user_read_untagged()
-        if str(chat_id) in users:
-            user_data = users[str(chat_id)]
+    return expire_vip_memberships([chat_id]) > 0
 
-            # Update user to Free status
-            users[str(chat_id)]["type"] = "Free"
+def expire_vip_memberships(chat_ids):
+    """Expire several VIP memberships with one user update and one membership delete"""
+    try:
+        existing = [str(chat_id) for chat_id in chat_ids if user_exists(chat_id)]
 
-            # Save updated user data
-            with open(os.path.join(os.path.dirname(__file__), "Json Files", "user.json"), 'w') as f:
-                json.dump(users, f, indent=4)
+        # Update users to Free status
+        if existing:
+            update_users({chat_id: {"type": "Free"} for chat_id in existing})
 
-            # Remove from membership tracking
-            membership_data = get_membership_data()
-            if str(chat_id) in membership_data:
-                del membership_data[str(chat_id)]
-                save_membership_data(membership_data)
+        # Remove from membership tracking
+        storage.get_backend().delete_many("memberships", [str(chat_id) for chat_id in chat_ids])
+        for chat_id in chat_ids:
+            _clear_expiry(chat_id)
 
-            # Notify user
+        # Notify users
+        for chat_id in existing:
             send_message(
                 chat_id=int(chat_id),
                 text="Your VIP membership has expired. You've been downgraded to Free status.\n\nTo regain VIP membership, refer 5 more users to the bot!"
             )
-
             log(f"VIP membership expired for {chat_id}")
-            return True
+
+        return len(existing)
     except Exception as e:
-        log(f"Error expiring VIP membership for {chat_id}: {e}")
-        return False
+        log(f"Error expiring VIP memberships for {chat_ids}: {e}")
+        return 0
 
 def process_membership_expiries():
     """Check all VIP memberships and expire those that have ended"""
     try:
-        membership_data = get_membership_data()
-        current_time = datetime.now()
-        expired_users = []
-
-        for chat_id, membership_info in membership_data.items():
-            expiry_date = datetime.strptime(membership_info["expiry_date"], "%Y-%m-%d %H:%M:%S")
-            if current_time > expiry_date:
-                expired_users.append(chat_id)
+        # Only the memberships at the front of the expiry heap are looked at
+        expired_users = due_membership_expiries()
 
-        for chat_id in expired_users:
-            expire_vip_membership(chat_id)
+        if expired_users:
+            expire_vip_memberships(expired_users)
 
         log(f"Processed {len(expired_users)} membership expiries")
         return len(expired_users)
@@ -226,6 +289,27 @@ def process_membership_expiries():
         log(f"Error processing membership expiries: {e}")
         return 0
 
+def schedule_membership_expiries():
+    """Schedule the expiry job for when the next membership ends"""
+    upcoming = next_membership_expiry()
+    if upcoming is None:
+        scheduler.cancel("membership_expiry")
+    else:
+        scheduler.schedule_at(upcoming[1], "membership_expiry")
+
+def run_membership_expiries():
+    """Expire the memberships that are due and schedule the next run"""
+    process_membership_expiries()
+    upcoming = next_membership_expiry()
+    if upcoming is None:
+        scheduler.cancel("membership_expiry")
+    else:
+        # A membership still due failed to expire, retry later instead of right away
+        now = time.time()
+        scheduler.schedule_at(upcoming[1] if upcoming[1] > now else now + MEMBERSHIP_RETRY_DELAY, "membership_expiry")
+
+scheduler.register_job("membership_expiry", run_membership_expiries)
+
 def get_referral_stats():
     """Get overall referral statistics"""
     try:
@@ -1,9 +1,19 @@
 import json
 import os
+import threading
+import time
 from datetime import datetime
 
 filepath = os.path.join(os.path.dirname(__file__), "Json Files", "root.json")
 
+RELOAD_CHECK_INTERVAL = 5  # Seconds between mtime checks of root.json
+
+# In-memory copy of root.json, reloaded only when the file's mtime changes
+_config = None
+_mtime = None
+_last_check = 0
+_lock = threading.RLock()
+
 
 def initialize_root_file():
     """Initialize root.json with default values if it doesn't exist"""
@@ -21,13 +31,47 @@ def initialize_root_file():
             json.dump(default_data, f, indent=4)
 
 
+def _load_config():
+    """Get the cached config, reloading it if root.json changed on disk"""
+    global _config, _mtime, _last_check
+    with _lock:
+        now = time.monotonic()
+        if _config is not None and now - _last_check < RELOAD_CHECK_INTERVAL:
+            return _config
+        _last_check = now
+
+        initialize_root_file()
+        mtime = os.path.getmtime(filepath)
+        if _config is None or mtime != _mtime:
+            with open(filepath, 'r') as rootfile:
+                _config = json.load(rootfile)
+            _mtime = mtime
+        return _config
+
+
+def _save_config(dictionary):
+    """Write the config to root.json and make it the cached copy"""
+    global _config, _mtime, _last_check
+    tmp_path = filepath + ".tmp"
+    with open(tmp_path, 'w') as rootfile:
+        json.dump(dictionary, rootfile, indent=4)
+    os.replace(tmp_path, filepath)
+    _config = dictionary
+    _mtime = os.path.getmtime(filepath)
+    _last_check = time.monotonic()
+
+
+def reload_config():
+    """Force the next read to check root.json on disk"""
+    global _last_check
+    with _lock:
+        _last_check = 0
+
+
 def root_read(tag):
     """Read specific value from root.json"""
     try:
-        initialize_root_file()
-        with open(filepath, 'r') as rootfile:
-            json_object = json.load(rootfile)
-        return json_object[tag]
+        return _load_config()[tag]
     except KeyError:
         raise KeyError(f"Tag '{tag}' not found in root.json")
     except Exception as e:
@@ -37,10 +81,7 @@ def root_read(tag):
 def root_read_untagged():
     """Read all data from root.json"""
     try:
-        initialize_root_file()
-        with open(filepath, 'r') as rootfile:
-            json_object = json.load(rootfile)
-        return json_object
+        return dict(_load_config())
     except Exception as e:
         raise Exception(f"Error reading root.json: {e}")
 
@@ -48,13 +89,7 @@ def root_read_untagged():
 def root_write(tag, data):
     """Write specific value to root.json"""
     try:
-        dictionary = root_read_untagged()
-        dictionary[tag] = data
-        dictionary["Last Updated"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-        with open(filepath, 'w') as rootfile:
-            json.dump(dictionary, rootfile, indent=4)
-
+        root_update_multiple({tag: data})
     except Exception as e:
         raise Exception(f"Error writing to root.json: {e}")
 
@@ -62,12 +97,11 @@ def root_write(tag, data):
 def root_update_multiple(updates_dict):
     """Update multiple values at once"""
     try:
-        dictionary = root_read_untagged()
-        dictionary.update(updates_dict)
-        dictionary["Last Updated"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-        with open(filepath, 'w') as rootfile:
-            json.dump(dictionary, rootfile, indent=4)
+        with _lock:
+            dictionary = dict(_load_config())
+            dictionary.update(updates_dict)
+            dictionary["Last Updated"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            _save_config(dictionary)
 
     except Exception as e:
         raise Exception(f"Error updating root.json: {e}")
@@ -0,0 +1,126 @@
+import heapq
+import itertools
+import threading
+import time
+from log import log
+
+# Registered jobs: name -> callable
+_jobs = {}
+# Pending runs as a min-heap of (due epoch, seq, name, args)
+_queue = []
+# (name, args) -> seq of its pending run; a newer schedule replaces the older one
+_pending = {}
+# name -> interval in seconds for jobs that repeat
+_intervals = {}
+_seq = itertools.count()
+_condition = threading.Condition()
+_thread = None
+
+
+def register_job(name, func):
+    """Register a job function under a name"""
+    with _condition:
+        _jobs[name] = func
+
+
+def schedule_at(when, name, *args):
+    """Run a registered job at epoch time `when`, replacing its pending run"""
+    with _condition:
+        seq = next(_seq)
+        _pending[(name, args)] = seq
+        heapq.heappush(_queue, (when, seq, name, args))
+        _condition.notify()
+
+
+def schedule_in(delay, name, *args):
+    """Run a registered job `delay` seconds from now"""
+    schedule_at(time.time() + delay, name, *args)
+
+
+def schedule_every(name, interval, first_run=None):
+    """Run a registered job every `interval` seconds, first after one interval by default"""
+    with _condition:
+        _intervals[name] = interval
+    schedule_at(first_run if first_run is not None else time.time() + interval, name)
+
+
+def due_time(name, *args):
+    """Get the epoch time a job is scheduled for, or None"""
+    with _condition:
+        seq = _pending.get((name, args))
+        for when, item_seq, _, _ in _queue:
+            if item_seq == seq:
+                return when
+        return None
+
+
+def cancel(name, *args):
+    """Cancel a job's pending run"""
+    with _condition:
+        _pending.pop((name, args), None)
+        if not args:
+            _intervals.pop(name, None)
+
+
+def next_due():
+    """Get the epoch time of the next pending run, or None"""
+    with _condition:
+        while _queue and _pending.get((_queue[0][2], _queue[0][3])) != _queue[0][1]:
+            heapq.heappop(_queue)
+        return _queue[0][0] if _queue else None
+
+
+def _pop_due(now):
+    """Take every run that is due, earliest first"""
+    due = []
+    with _condition:
+        while _queue and _queue[0][0] <= now:
+            when, seq, name, args = heapq.heappop(_queue)
+            if _pending.get((name, args)) != seq:
+                continue  # Replaced or cancelled
+            del _pending[(name, args)]
+            due.append((name, args))
+    return due
+
+
+def run_pending(now=None):
+    """Run every job that is due, returns how many ran"""
+    now = time.time() if now is None else now
+    ran = 0
+    for name, args in _pop_due(now):
+        func = _jobs.get(name)
+        if func is None:
+            log(f"Scheduled job '{name}' is not registered")
+            continue
+        try:
+            func(*args)
+        except Exception as e:
+            log(f"Error running scheduled job '{name}': {e}")
+        ran += 1
+
+        interval = _intervals.get(name)
+        if interval is not None and not args:
+            with _condition:
+                if (name, args) not in _pending:
+                    schedule_at(time.time() + interval, name)
+    return ran
+
+
+def _run_forever():
+    """Sleep until the next run is due and run it"""
+    while True:
+        with _condition:
+            due = next_due()
+            timeout = None if due is None else max(0, due - time.time())
+            if timeout is None or timeout > 0:
+                _condition.wait(timeout)
+        run_pending()
+
+
+def start():
+    """Run the scheduler in a background thread"""
+    global _thread
+    with _condition:
+        if _thread is None:
+            _thread = threading.Thread(target=_run_forever, name="scheduler", daemon=True)
+            _thread.start()
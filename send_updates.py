@@ -1,13 +1,84 @@
 
-import requests
+import json
 import os
+import queue
+import threading
+import time
+import http_client
+import metrics
+import rate_limit
 import root_json
 from log import log
 
 BASE_URL = root_json.root_read("BASE_URL")
 
-def send_message(chat_id, text, reply_markup=None, parse_mode=None):
-    """Send message to user"""
+# Set by the asyncio runtime so JSON calls from handler threads go through its event loop, see set_async_sender
+_async_sender = None
+
+# Bulk messages are sent from their own thread so callers (the scheduler) don't wait on the rate limits
+_bulk_queue = queue.Queue()
+_bulk_sender = None
+_bulk_lock = threading.Lock()
+
+class _SentResponse:
+    """The parts of a requests response the senders use, for a call made by the asyncio runtime"""
+
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+        self.text = content.decode(errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+def set_async_sender(sender):
+    """Send JSON API calls through sender(method, data, bulk), which returns (status, body) or None
+
+    The asyncio runtime installs one that runs the call on its event loop
+    and HTTP client; None from it (or no sender) means calling directly.
+    """
+    global _async_sender
+    _async_sender = sender
+
+def _post(url, chat_id=None, bulk=False, **kwargs):
+    """POST an API call within the rate limits, retrying 429 and 5xx responses
+
+    Waits for the global and per-chat token buckets. A 429 on a message
+    pauses only its chat; calls without a chat just retry. Waits longer
+    than rate_limit.MAX_BLOCKING_WAIT fail fast instead of holding the
+    handler thread. Returns the last response.
+    """
+    sender = _async_sender
+    if sender is not None and 'json' in kwargs:
+        sent = sender(url.rsplit('/', 1)[-1], kwargs['json'], bulk)
+        if sent is not None:
+            return _SentResponse(*sent)
+    for attempt in range(rate_limit.MAX_RETRIES + 1):
+        rate_limit.acquire(chat_id, bulk, max_wait=rate_limit.MAX_BLOCKING_WAIT)
+        response = http_client.post(url, **kwargs)
+        if response.status_code == 429:
+            delay = rate_limit.retry_after(response.text)
+            if chat_id is not None:
+                rate_limit.pause(chat_id, delay)
+        elif response.status_code >= 500:
+            delay = rate_limit.backoff_delay(attempt)
+        else:
+            return response
+
+        if attempt == rate_limit.MAX_RETRIES or delay > rate_limit.MAX_BLOCKING_WAIT:
+            break
+        log(f"Telegram answered {response.status_code} for {url.rsplit('/', 1)[-1]}, retrying in {delay:.1f}s")
+        metrics.increment("telegram_retries")
+        # A paused chat is waited out in acquire()
+        if chat_id is None or response.status_code >= 500:
+            time.sleep(delay)
+        # Uploads are read again from the start
+        for file in kwargs.get('files', {}).values():
+            file.seek(0)
+    return response
+
+def send_message(chat_id, text, reply_markup=None, parse_mode=None, bulk=False):
+    """Send message to user, bulk messages (notifications, reminders) wait behind chat relays"""
     url = f"{BASE_URL}/sendMessage"
     data = {
         "chat_id": chat_id,
@@ -20,7 +91,7 @@ def send_message(chat_id, text, reply_markup=None, parse_mode=None):
         data["parse_mode"] = parse_mode
 
     try:
-        response = requests.post(url, json=data)
+        response = _post(url, chat_id, bulk, json=data)
         if response.status_code != 200:
             log(f"Error sending message to {chat_id}: {response.text}")
         return response
@@ -28,6 +99,42 @@ def send_message(chat_id, text, reply_markup=None, parse_mode=None):
         log(f"Exception sending message to {chat_id}: {e}")
         return None
 
+def call_method(method, data, bulk=False):
+    """Call a Bot API method with a JSON body, e.g. one built by get_updates.relay_calls"""
+    try:
+        response = _post(f"{BASE_URL}/{method}", data.get("chat_id"), bulk, json=data)
+        if response.status_code != 200:
+            log(f"Error calling {method} for {data.get('chat_id')}: {response.text}")
+        return response
+    except Exception as e:
+        log(f"Exception calling {method} for {data.get('chat_id')}: {e}")
+        return None
+
+def _send_bulk_forever():
+    """Send queued bulk messages one by one within the rate limits"""
+    while True:
+        chat_id, text, reply_markup = _bulk_queue.get()
+        send_message(chat_id=chat_id, text=text, reply_markup=reply_markup, bulk=True)
+
+def send_messages(messages):
+    """Queue a batch of (chat_id, text) or (chat_id, text, reply_markup) messages for the bulk sender
+
+    Returns how many were queued. At 30 messages a second a large batch
+    takes a while, so it is sent from the bulk sender thread.
+    """
+    global _bulk_sender
+    with _bulk_lock:
+        if _bulk_sender is None:
+            _bulk_sender = threading.Thread(target=_send_bulk_forever, name="bulk-sender", daemon=True)
+            _bulk_sender.start()
+    queued = 0
+    for chat_id, text, *reply_markup in messages:
+        _bulk_queue.put((chat_id, text, reply_markup[0] if reply_markup else None))
+        queued += 1
+    return queued
+
+metrics.register_gauge("bulk_messages_queued", _bulk_queue.qsize)
+
 def send_photo(chat_id, photo, caption=None, reply_markup=None):
     """Send photo to user"""
     url = f"{BASE_URL}/sendPhoto"
@@ -44,7 +151,7 @@ def send_photo(chat_id, photo, caption=None, reply_markup=None):
                 data['reply_markup'] = reply_markup
 
             try:
-                response = requests.post(url, data=data, files=files)
+                response = _post(url, chat_id, data=data, files=files, timeout=http_client.TRANSFER_TIMEOUT)
                 if response.status_code != 200:
                     log(f"Error sending photo to {chat_id}: {response.text}")
                 return response
@@ -63,7 +170,7 @@ def send_photo(chat_id, photo, caption=None, reply_markup=None):
             data["reply_markup"] = reply_markup
 
         try:
-            response = requests.post(url, json=data)
+            response = _post(url, chat_id, json=data)
             if response.status_code != 200:
                 log(f"Error sending photo to {chat_id}: {response.text}")
             return response
@@ -87,7 +194,7 @@ def send_document(chat_id, document, caption=None, reply_markup=None):
                 data['reply_markup'] = reply_markup
 
             try:
-                response = requests.post(url, data=data, files=files)
+                response = _post(url, chat_id, data=data, files=files, timeout=http_client.TRANSFER_TIMEOUT)
                 if response.status_code != 200:
                     log(f"Error sending document to {chat_id}: {response.text}")
                 return response
@@ -106,7 +213,7 @@ def send_document(chat_id, document, caption=None, reply_markup=None):
             data["reply_markup"] = reply_markup
 
         try:
-            response = requests.post(url, json=data)
+            response = _post(url, chat_id, json=data)
             if response.status_code != 200:
                 log(f"Error sending document to {chat_id}: {response.text}")
             return response
@@ -132,7 +239,7 @@ def send_voice(chat_id, voice, caption=None, duration=None, reply_markup=None):
                 data['reply_markup'] = reply_markup
 
             try:
-                response = requests.post(url, data=data, files=files)
+                response = _post(url, chat_id, data=data, files=files, timeout=http_client.TRANSFER_TIMEOUT)
                 if response.status_code != 200:
                     log(f"Error sending voice to {chat_id}: {response.text}")
                 return response
@@ -153,7 +260,7 @@ def send_voice(chat_id, voice, caption=None, duration=None, reply_markup=None):
             data["reply_markup"] = reply_markup
 
         try:
-            response = requests.post(url, json=data)
+            response = _post(url, chat_id, json=data)
             if response.status_code != 200:
                 log(f"Error sending voice to {chat_id}: {response.text}")
             return response
@@ -167,7 +274,7 @@ def get_file(file_id):
     data = {"file_id": file_id}
 
     try:
-        response = requests.post(url, json=data)
+        response = _post(url, None, json=data)
         if response.status_code == 200:
             result = response.json()
             if result['ok']:
@@ -185,7 +292,7 @@ def download_file(file_path, save_path):
     download_url = f"https://api.telegram.org/file/bot{bot_token}/{file_path}"
 
     try:
-        response = requests.get(download_url)
+        response = http_client.get(download_url, timeout=http_client.TRANSFER_TIMEOUT)
         if response.status_code == 200:
             # Create directory if it doesn't exist
             os.makedirs(os.path.dirname(save_path), exist_ok=True)
@@ -216,7 +323,7 @@ def edit_message(chat_id, message_id, text, reply_markup=None, parse_mode=None):
         data["parse_mode"] = parse_mode
 
     try:
-        response = requests.post(url, json=data)
+        response = _post(url, chat_id, json=data)
         if response.status_code != 200:
             log(f"Error editing message for {chat_id}: {response.text}")
         return response
@@ -239,7 +346,7 @@ def edit_message_caption(chat_id, message_id, caption, reply_markup=None, parse_
         data["parse_mode"] = parse_mode
 
     try:
-        response = requests.post(url, json=data)
+        response = _post(url, chat_id, json=data)
         if response.status_code != 200:
             log(f"Error editing message caption for {chat_id}: {response.text}")
         return response
@@ -259,7 +366,7 @@ def answer_callback_query(callback_query_id, text=None, show_alert=False):
         data["text"] = text
 
     try:
-        response = requests.post(url, json=data)
+        response = _post(url, None, json=data)
         if response.status_code != 200:
             log(f"Error answering callback query: {response.text}")
         return response
@@ -277,7 +384,7 @@ def forward_message(chat_id, from_chat_id, message_id):
     }
 
     try:
-        response = requests.post(url, json=data)
+        response = _post(url, chat_id, json=data)
         if response.status_code != 200:
             log(f"Error forwarding message: {response.text}")
         return response
@@ -298,7 +405,7 @@ def copy_message(chat_id, from_chat_id, message_id, caption=None):
         data["caption"] = caption
 
     try:
-        response = requests.post(url, json=data)
+        response = _post(url, chat_id, json=data)
         if response.status_code != 200:
             log(f"Error copying message: {response.text}")
         return response
@@ -0,0 +1,286 @@
+import copy
+import json
+import os
+import sqlite3
+import sys
+import threading
+from log import log
+
+data_dir = os.path.join(os.path.dirname(__file__), "Json Files")
+sqlite_path = os.path.join(data_dir, "ghostchat.db")
+
+# Storage tables and the JSON file backing each one
+TABLES = {
+    "users": "user.json",
+    "lobby": "lobby.json",
+    "matches": "matches.json",
+    "referrals": "referrals.json",
+    "memberships": "memberships.json"
+}
+
+# Backend used when STORAGE_BACKEND is not set
+DEFAULT_BACKEND = "json"
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+class JsonBackend:
+    """Stores every table as a whole JSON file under Json Files/"""
+
+    def __init__(self, directory=data_dir):
+        self.directory = directory
+        self._locks = {table: threading.RLock() for table in TABLES}
+
+    def _path(self, table):
+        return os.path.join(self.directory, TABLES[table])
+
+    def initialize(self, table):
+        """Create the table's file if it doesn't exist"""
+        path = self._path(table)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                json.dump({}, f)
+
+    def _load(self, table):
+        self.initialize(table)
+        try:
+            with open(self._path(table), 'r') as f:
+                return json.load(f)
+        except Exception as e:
+            log(f"Error reading {TABLES[table]}: {e}")
+            return {}
+
+    def _save(self, table, data):
+        path = self._path(table)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=4)
+        os.replace(tmp_path, path)
+
+    def get(self, table, key):
+        """Get one record, or None if it doesn't exist"""
+        with self._locks[table]:
+            return self._load(table).get(str(key))
+
+    def all(self, table):
+        """Get all records of a table as a dict"""
+        with self._locks[table]:
+            return self._load(table)
+
+    def count(self, table):
+        """Get the number of records in a table"""
+        with self._locks[table]:
+            return len(self._load(table))
+
+    def put(self, table, key, record):
+        """Insert or replace one record"""
+        self.put_many(table, {str(key): record})
+
+    def put_many(self, table, records):
+        """Insert or replace several records in one write"""
+        if not records:
+            return
+        with self._locks[table]:
+            data = self._load(table)
+            for key, record in records.items():
+                data[str(key)] = record
+            self._save(table, data)
+
+    def delete(self, table, key):
+        """Delete one record, returns True if it existed"""
+        return self.delete_many(table, [key]) > 0
+
+    def delete_many(self, table, keys):
+        """Delete several records in one write, returns how many existed"""
+        with self._locks[table]:
+            data = self._load(table)
+            removed = 0
+            for key in keys:
+                if data.pop(str(key), None) is not None:
+                    removed += 1
+            if removed:
+                self._save(table, data)
+            return removed
+
+    def replace_all(self, table, records):
+        """Replace the whole table with records"""
+        with self._locks[table]:
+            self._save(table, {str(key): record for key, record in records.items()})
+
+
+class SqliteBackend:
+    """Stores every table as an indexed SQLite table in WAL mode"""
+
+    def __init__(self, path=sqlite_path):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._create_tables()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _create_tables(self):
+        conn = self._connection()
+        with conn:
+            for table in TABLES:
+                conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, data TEXT NOT NULL)")
+            # Membership expiries are indexed in memory by referral.py now
+            conn.execute("DROP INDEX IF EXISTS idx_memberships_expiry_date")
+
+    def _row(self, table, key, record):
+        return (str(key), json.dumps(record))
+
+    def _insert_sql(self, table):
+        return f"INSERT OR REPLACE INTO {table} (key, data) VALUES (?, ?)"
+
+    def initialize(self, table):
+        """Tables are created when the backend is opened"""
+        pass
+
+    def get(self, table, key):
+        """Get one record, or None if it doesn't exist"""
+        row = self._connection().execute(f"SELECT data FROM {table} WHERE key = ?", (str(key),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def all(self, table):
+        """Get all records of a table as a dict"""
+        rows = self._connection().execute(f"SELECT key, data FROM {table}").fetchall()
+        return {key: json.loads(data) for key, data in rows}
+
+    def count(self, table):
+        """Get the number of records in a table"""
+        return self._connection().execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+    def put(self, table, key, record):
+        """Insert or replace one record"""
+        self.put_many(table, {key: record})
+
+    def put_many(self, table, records):
+        """Insert or replace several records in one transaction"""
+        if not records:
+            return
+        conn = self._connection()
+        with conn:
+            conn.executemany(self._insert_sql(table),
+                             [self._row(table, key, record) for key, record in records.items()])
+
+    def delete(self, table, key):
+        """Delete one record, returns True if it existed"""
+        return self.delete_many(table, [key]) > 0
+
+    def delete_many(self, table, keys):
+        """Delete several records in one transaction, returns how many existed"""
+        conn = self._connection()
+        with conn:
+            cursor = conn.executemany(f"DELETE FROM {table} WHERE key = ?", [(str(key),) for key in keys])
+            return cursor.rowcount
+
+    def replace_all(self, table, records):
+        """Replace the whole table with records"""
+        conn = self._connection()
+        with conn:
+            conn.execute(f"DELETE FROM {table}")
+            conn.executemany(self._insert_sql(table),
+                             [self._row(table, key, record) for key, record in records.items()])
+
+
+class MemoryBackend:
+    """Keeps every table in process memory, used by the benchmarks"""
+
+    def __init__(self):
+        self.tables = {table: {} for table in TABLES}
+        self._lock = threading.RLock()
+
+    def initialize(self, table):
+        """Nothing to create for in-memory tables"""
+        pass
+
+    def get(self, table, key):
+        """Get one record, or None if it doesn't exist"""
+        with self._lock:
+            return copy.deepcopy(self.tables[table].get(str(key)))
+
+    def all(self, table):
+        """Get all records of a table as a dict"""
+        with self._lock:
+            return copy.deepcopy(self.tables[table])
+
+    def count(self, table):
+        """Get the number of records in a table"""
+        return len(self.tables[table])
+
+    def put(self, table, key, record):
+        """Insert or replace one record"""
+        self.put_many(table, {key: record})
+
+    def put_many(self, table, records):
+        """Insert or replace several records"""
+        with self._lock:
+            for key, record in records.items():
+                self.tables[table][str(key)] = copy.deepcopy(record)
+
+    def delete(self, table, key):
+        """Delete one record, returns True if it existed"""
+        return self.delete_many(table, [key]) > 0
+
+    def delete_many(self, table, keys):
+        """Delete several records, returns how many existed"""
+        with self._lock:
+            return sum(1 for key in keys if self.tables[table].pop(str(key), None) is not None)
+
+    def replace_all(self, table, records):
+        """Replace the whole table with records"""
+        with self._lock:
+            self.tables[table] = {str(key): copy.deepcopy(record) for key, record in records.items()}
+
+
+def create_backend(name):
+    """Create a storage backend by name ('json', 'sqlite' or 'memory')"""
+    if name == "json":
+        return JsonBackend()
+    if name == "sqlite":
+        return SqliteBackend()
+    if name == "memory":
+        return MemoryBackend()
+    raise ValueError(f"Unknown storage backend '{name}'")
+
+
+def get_backend():
+    """Get the process-wide storage backend chosen by STORAGE_BACKEND"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                name = os.environ.get('STORAGE_BACKEND', DEFAULT_BACKEND).lower()
+                _backend = create_backend(name)
+                log(f"Using {name} storage backend")
+    return _backend
+
+
+def migrate_json_to_sqlite(directory=data_dir, path=sqlite_path):
+    """Import every JSON file into the SQLite database"""
+    source = JsonBackend(directory)
+    target = SqliteBackend(path)
+    counts = {}
+    for table in TABLES:
+        records = source.all(table)
+        target.replace_all(table, records)
+        counts[table] = len(records)
+        log(f"Migrated {len(records)} records from {TABLES[table]} to {table}")
+    return counts
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate":
+        print(migrate_json_to_sqlite())
+    else:
+        print("Usage: python3 storage.py migrate")
@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Keep the bot's data files out of the tests
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+
+
+@pytest.fixture(autouse=True)
+def work_dir(tmp_path, monkeypatch):
+    """Run each test in its own directory, where logs and temp files are written"""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
@@ -0,0 +1,111 @@
+import asyncio
+import json
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import async_runtime
+import get_updates
+import match_registry
+import root_json
+import send_updates
+import user_json
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Answers Bot API calls like Telegram, recording every call"""
+    protocol_version = "HTTP/1.1"
+    wbufsize = 65536  # One write per response, so keep-alive requests aren't held by delayed ACKs
+
+    def _answer(self, body):
+        method = urllib.parse.urlsplit(self.path).path.rsplit("/", 1)[-1]
+        if method == "getUpdates":
+            offset = int(urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)["offset"][0])
+            result = [update for update in self.server.updates if update["update_id"] >= offset]
+            if not result:
+                time.sleep(0.05)
+        else:
+            self.server.calls.append((method, json.loads(body) if body else None))
+            result = {"message_id": len(self.server.calls)}
+        payload = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        self._answer(b"")
+
+    def do_POST(self):
+        self._answer(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stand_in(tmp_path, monkeypatch):
+    """Local stand-in for the Bot API, with root.json and the bot's logs pointed at tmp_path"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.updates = []
+    server.calls = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    root_path = tmp_path / "root.json"
+    root_path.write_text(json.dumps({"BASE_URL": f"http://127.0.0.1:{server.server_port}/botTEST", "offset": 0,
+                                     "Total Users": 0}))
+    monkeypatch.setattr(root_json, "filepath", str(root_path))
+    monkeypatch.setattr(root_json, "_config", None)
+    monkeypatch.setattr(get_updates, "journal_filepath", str(tmp_path / "processed_updates.log"))
+    monkeypatch.setattr(get_updates, "spool_filepath", str(tmp_path / "received_updates.log"))
+    monkeypatch.setattr(match_registry, "log_filepath", str(tmp_path / "matches.log"))
+    # Handler threads must send through the event loop, never directly
+    monkeypatch.setattr(send_updates.http_client, "post", lambda *args, **kwargs: pytest.fail("direct HTTP call"))
+    yield server
+    match_registry.compact()  # Before the paths are restored, rather than at exit
+    server.shutdown()
+    server.server_close()
+
+
+def message(update_id, chat_id, **fields):
+    return {"update_id": update_id,
+            "message": dict({"message_id": update_id, "from": {"id": chat_id}, "chat": {"id": chat_id}}, **fields)}
+
+
+async def run_until(server, calls, timeout=10):
+    """Run the asyncio runtime until the stand-in has received the given number of calls"""
+    task = asyncio.create_task(async_runtime.run(TIMEOUT=0))
+    deadline = time.monotonic() + timeout
+    while len(server.calls) < calls and time.monotonic() < deadline:
+        await asyncio.sleep(0.02)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+
+def test_relays_and_handler_replies_go_through_the_loop(stand_in):
+    user_json.add_user("101", "Ann", "", "ann", "Female")
+    user_json.add_user("202", "Bob", "", "bob", "Male")
+    match_registry.add_match("101", "202")
+    stand_in.updates = [
+        message(1, 101, text="hello"),
+        message(2, 202, photo=[{"file_id": "small"}, {"file_id": "large"}]),
+        {"update_id": 3, "edited_message": {"message_id": 1, "from": {"id": 101}, "chat": {"id": 101},
+                                            "text": "hello again"}},
+        message(4, 202, text="/help"),
+    ]
+
+    asyncio.run(run_until(stand_in, 4))
+
+    calls = {(method, str(data["chat_id"]), data.get("text") or data.get("photo")) for method, data in stand_in.calls}
+    assert ("sendMessage", "202", "🧒 hello") in calls
+    assert ("sendPhoto", "101", "large") in calls
+    assert ("sendMessage", "202", "🧒 ✏️ (edited): hello again") in calls
+    # /help runs the blocking handler in a thread; its reply went through the loop's client
+    assert any(method == "sendMessage" and chat_id == "202" and "Help" in text for method, chat_id, text in calls)
+    assert len(stand_in.calls) == 4
+    assert all(get_updates.already_processed(update_id) for update_id in (1, 2, 3, 4))
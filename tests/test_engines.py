@@ -0,0 +1,119 @@
+import random
+
+import pytest
+
+from check_engines import random_lobby, random_recent, pair_problems, brute_force_best
+from lobby_index import bucket_key, keys_compatible, greedy_pairs
+from lobby_maximum import maximum_pairs
+from recent_pairs import RecentPairs
+
+
+def first_fit_pairs(users, recent=None):
+    """Reference greedy: every user in order takes the first compatible user after it"""
+    keys = [bucket_key(user_id, entry) for user_id, entry, _ in users]
+    matched = set()
+    pairs = []
+    for first in range(len(users)):
+        if first in matched or keys[first] is None:
+            continue
+        for second in range(first + 1, len(users)):
+            if (second not in matched and keys[second] is not None and keys_compatible(keys[first], keys[second])
+                    and not (recent and recent.contains(users[first][0], users[second][0]))):
+                matched.update((first, second))
+                pairs.append((first, second))
+                break
+    return pairs
+
+
+def entry(gender, prefer="Any", **fields):
+    return dict({"gender": gender, "prefer": prefer, "type": "Free", "match_org": False, "domain": None,
+                 "joined_at": 0}, **fields)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_greedy_matches_first_fit(seed):
+    rng = random.Random(seed)
+    for _ in range(50):
+        users = random_lobby(rng.randint(2, 80), rng)
+        recent = random_recent(users, rng)
+        pairs = greedy_pairs(users, recent=recent)
+        assert set(map(frozenset, pairs)) == set(map(frozenset, first_fit_pairs(users, recent)))
+        assert pair_problems(users, pairs, recent) is None
+
+
+def test_greedy_skips_recent_partners():
+    users = [("1", entry("Male"), 3), ("2", entry("Female"), 2), ("3", entry("Female"), 1)]
+    assert greedy_pairs(users) == [(0, 1)]
+
+    recent = RecentPairs(capacity=1000)
+    recent.add("1", "2")
+    assert greedy_pairs(users, recent=recent) == [(0, 2)]
+
+
+def test_greedy_keeps_org_users_in_their_domain():
+    users = [("1", entry("Male", match_org=True, domain="a.edu"), 3),
+             ("2", entry("Female", match_org=True, domain="b.edu"), 2),
+             ("3", entry("Female"), 1),
+             ("4", entry("Female", match_org=True, domain="a.edu"), 0)]
+    assert greedy_pairs(users) == [(0, 3)]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_maximum_is_optimal_on_small_lobbies(seed):
+    rng = random.Random(seed)
+    for _ in range(40):
+        users = random_lobby(rng.randint(2, 11), rng)
+        pairs = maximum_pairs(users, budget=60)
+        expected_pairs, expected_unpaired = brute_force_best(users)
+        paired = {position for pair in pairs for position in pair}
+        assert len(pairs) == expected_pairs
+        # Among the largest pairings, the lowest-priority users are the ones left out
+        assert sum(position for position in range(len(users)) if position not in paired) == expected_unpaired
+        assert pair_problems(users, pairs, RecentPairs(capacity=1000)) is None
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_maximum_pairs_at_least_as_many_as_greedy(seed):
+    rng = random.Random(seed)
+    for _ in range(10):
+        users = random_lobby(rng.randint(50, 400), rng)
+        recent = random_recent(users, rng)
+        pairs = maximum_pairs(users, budget=60, recent=recent)
+        assert pair_problems(users, pairs, recent) is None
+        assert len(pairs) >= len(greedy_pairs(users, recent=recent)) - len(recent_conflicts(users, recent))
+
+
+def recent_conflicts(users, recent):
+    """Positions of lobby users with a recent partner in the lobby"""
+    return {position for position, (user_id, _, _) in enumerate(users)
+            for other_id, _, _ in users if other_id != user_id and recent.contains(user_id, other_id)}
+
+
+def test_maximum_skips_recent_partners():
+    # Maximum would pair 1-3 and 2-4, but 1 and 3 were just paired
+    users = [("1", entry("Male", "Female"), 4), ("2", entry("Male"), 3),
+             ("3", entry("Female", "Male"), 2), ("4", entry("Male"), 1)]
+    assert maximum_pairs(users, budget=60) == [(0, 2), (1, 3)]
+
+    recent = RecentPairs(capacity=1000)
+    recent.add("1", "3")
+    pairs = maximum_pairs(users, budget=60, recent=recent)
+    assert pair_problems(users, pairs, recent) is None
+    assert (0, 2) not in pairs
+
+
+def test_maximum_prefers_higher_priority_users():
+    # Two pairs at most either way; the female can only take a male, so the lowest-priority male waits
+    users = [("1", entry("Male"), 5), ("2", entry("Male"), 4), ("3", entry("Female", "Male"), 3),
+             ("4", entry("Male"), 2), ("5", entry("Male"), 1)]
+    pairs = maximum_pairs(users, budget=60)
+    assert len(pairs) == 2
+    assert {position for pair in pairs for position in pair} == {0, 1, 2, 3}
+
+
+def test_maximum_over_budget_falls_back_to_greedy():
+    rng = random.Random(1)
+    users = random_lobby(500, rng)
+    recent = random_recent(users, rng)
+    pairs = maximum_pairs(users, budget=0, recent=recent)
+    assert set(map(frozenset, pairs)) == set(map(frozenset, greedy_pairs(users, recent=recent)))
@@ -0,0 +1,64 @@
+import pickle
+import random
+
+import pytest
+
+import lobby_index
+import match_shards
+from check_engines import random_lobby, random_recent
+from lobby_index import greedy_pairs
+from recent_pairs import RecentPairs
+
+
+@pytest.fixture
+def workers(monkeypatch):
+    monkeypatch.setattr(match_shards, "MATCH_WORKERS", 2)
+    monkeypatch.setattr(match_shards, "MIN_SHARDED_LOBBY", 2)
+    # A failing pool falls back to pairing in-process, which would hide worker bugs
+    monkeypatch.setattr(match_shards, "log", pytest.fail)
+    yield
+    match_shards.shutdown()
+
+
+def test_partition_lobby_groups_by_org_domain():
+    users = [("1", {"gender": "Male", "match_org": False}, 4),
+             ("2", {"gender": "Female", "match_org": True, "domain": "org0.edu"}, 3),
+             ("3", {"gender": "Male", "match_org": True, "domain": None}, 2),
+             ("4", {"gender": "Male", "match_org": True, "domain": "org0.edu"}, 1)]
+    assert match_shards.partition_lobby(users) == {(False, None): [0], (True, "org0.edu"): [1, 3]}
+
+
+def test_plan_shards_keeps_partitions_whole_and_balanced():
+    partitions = {"a": [0, 3, 5, 7], "b": [1, 4], "c": [2, 6], "d": [8]}
+    plan = match_shards.plan_shards(partitions, 2)
+    assert sorted(map(len, plan)) == [4, 5]
+    for positions in partitions.values():
+        assert sum(set(positions) <= set(shard) for shard in plan) == 1
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_sharded_pairs_match_in_process(workers, seed):
+    rng = random.Random(seed)
+    users = random_lobby(300, rng)
+    recent = random_recent(users, rng)
+    expected = greedy_pairs(users, recent=recent)
+    assert match_shards.sharded_pairs(greedy_pairs, users, recent=recent) == expected
+
+
+def test_sharded_pairs_resolve_legacy_domains(workers, monkeypatch):
+    # Entries from before domains were stored; only the coordinator can look them up
+    users = [(str(number), {"gender": "Male", "prefer": "Any", "type": "Free", "match_org": True,
+                            "joined_at": 0}, 4 - number) for number in range(4)]
+    monkeypatch.setattr(lobby_index, "entry_domain", lambda user_id, entry: entry.get("domain", "org0.edu"))
+    assert match_shards.sharded_pairs(greedy_pairs, users) == [(0, 1), (2, 3)]
+
+
+def test_shared_recent_pairs_pickle_by_name():
+    recent = RecentPairs(capacity=1000)
+    recent.add("1", "2")
+    recent.share()
+    copy = pickle.loads(pickle.dumps(recent))
+    assert copy.contains("1", "2") and not copy.contains("1", "3")
+    recent.add("1", "3")
+    assert copy.contains("1", "3")
+    assert len(pickle.dumps(recent)) < 1000
@@ -1,26 +1,92 @@
-import json
+import atexit
 import os
+import threading
 from datetime import datetime
 from log import log
 import root_json
+import storage
 
 filepath = os.path.join(os.path.dirname(__file__), "Json Files", "user.json")
 referral_path = os.path.join(os.path.dirname(__file__), "Json Files", "referral.json")
 
+FLUSH_INTERVAL = 5  # Seconds between background flushes of dirty users
+FLUSH_THRESHOLD = 100  # Number of dirty users that triggers an early flush
+
+# Process-wide user store, loaded once and flushed in the background
+_users = None
+_dirty = set()
+_lock = threading.RLock()
+_flush_lock = threading.Lock()
+_flush_event = threading.Event()
+_flush_thread = None
+
 def initialize_user_file():
     """Initialize user file if it doesn't exist"""
-    if not os.path.exists(filepath):
-        os.makedirs(os.path.dirname(filepath), exist_ok=True)
-        with open(filepath, 'w') as f:
-            json.dump({}, f)
+    storage.get_backend().initialize("users")
+
+def _load_users():
+    """Load users into memory on first use and start the flush thread"""
+    global _users
+    with _lock:
+        if _users is None:
+            try:
+                _users = storage.get_backend().all("users")
+            except Exception as e:
+                log(f"Error loading users: {e}")
+                _users = {}
+            _start_flush_thread()
+        return _users
+
+def _mark_dirty(chat_id):
+    """Mark a user record as changed since the last flush"""
+    _dirty.add(str(chat_id))
+    if len(_dirty) >= FLUSH_THRESHOLD:
+        _flush_event.set()
+
+def _flush_loop():
+    """Flush dirty users every FLUSH_INTERVAL seconds or when signalled"""
+    while True:
+        _flush_event.wait(FLUSH_INTERVAL)
+        _flush_event.clear()
+        try:
+            flush_users()
+        except Exception as e:
+            log(f"Error in user flush thread: {e}")
+
+def _start_flush_thread():
+    """Start the background flush thread once per process"""
+    global _flush_thread
+    if _flush_thread is None:
+        _flush_thread = threading.Thread(target=_flush_loop, name="user-flush", daemon=True)
+        _flush_thread.start()
+        atexit.register(flush_users)
+
+def flush_users():
+    """Write all pending user changes to storage"""
+    with _flush_lock:
+        with _lock:
+            if _users is None or not _dirty:
+                return 0
+            pending = set(_dirty)
+            _dirty.clear()
+            records = {chat_id: dict(_users[chat_id]) for chat_id in pending if chat_id in _users}
+
+        try:
+            storage.get_backend().put_many("users", records)
+        except Exception as e:
+            with _lock:
+                _dirty.update(pending)
+            log(f"Error flushing users: {e}")
+            raise
+
+        return len(pending)
 
 def user_read_untagged():
     """Read all users data"""
     try:
-        initialize_user_file()
-        with open(filepath, 'r') as userfile:
-            json_object = json.load(userfile)
-        return json_object
+        users = _load_users()
+        with _lock:
+            return {chat_id: dict(user_data) for chat_id, user_data in users.items()}
     except Exception as e:
         log(f"Error reading users: {e}")
         return {}
@@ -28,10 +94,9 @@ def user_read_untagged():
 def user_read(chat_id):
     """Read specific user data"""
     try:
-        initialize_user_file()
-        with open(filepath, 'r') as userfile:
-            json_object = json.load(userfile)
-        return json_object[str(chat_id)]
+        users = _load_users()
+        with _lock:
+            return dict(users[str(chat_id)])
     except KeyError:
         raise KeyError(f"User {chat_id} not found")
     except Exception as e:
@@ -41,28 +106,25 @@ def user_read(chat_id):
 def add_user(chat_id, first_name, last_name, username, gender, email=None, match_org= False):
     """Add new user to database"""
     try:
-        initialize_user_file()
-        dictionary = user_read_untagged()
+        users = _load_users()
 
         now = datetime.now()
         formatted_date = now.strftime("%d-%m-%Y")
 
-        dictionary[str(chat_id)] = {
-            "first_name": first_name,
-            "last_name": last_name,
-            "username": username,
-            "gender": gender,
-            "prefer": "Any",  # Default preference
-            "type": "Free",  # Default user type
-            "email": email,  # User email
-            "match_org" : False,
-            "date": formatted_date,
-            "created_at": now.strftime("%Y-%m-%d %H:%M:%S")
-        }
-
-        # Save to file
-        with open(filepath, 'w') as userfile:
-            json.dump(dictionary, userfile, indent=4)
+        with _lock:
+            users[str(chat_id)] = {
+                "first_name": first_name,
+                "last_name": last_name,
+                "username": username,
+                "gender": gender,
+                "prefer": "Any",  # Default preference
+                "type": "Free",  # Default user type
+                "email": email,  # User email
+                "match_org" : False,
+                "date": formatted_date,
+                "created_at": now.strftime("%Y-%m-%d %H:%M:%S")
+            }
+            _mark_dirty(chat_id)
 
         log(f"Added user {chat_id}, Name: {first_name} {last_name}, Gender: {gender}, Email: {email}")
 
@@ -77,31 +139,33 @@ def add_user(chat_id, first_name, last_name, username, gender, email=None, match
         log(f"Error adding user {chat_id}: {e}")
         raise
 
+def update_user(chat_id, **fields):
+    """Apply a partial update to one user record"""
+    return update_users({chat_id: fields})[str(chat_id)]
+
+def update_users(updates):
+    """Apply partial updates to several user records at once"""
+    users = _load_users()
+    with _lock:
+        missing = [chat_id for chat_id in updates if str(chat_id) not in users]
+        if missing:
+            raise KeyError(f"Users {', '.join(map(str, missing))} not found")
+
+        updated = {}
+        for chat_id, fields in updates.items():
+            users[str(chat_id)].update(fields)
+            _mark_dirty(chat_id)
+            updated[str(chat_id)] = dict(users[str(chat_id)])
+        return updated
+
 def makeVIP(chat_id):
     """Upgrade user to VIP status"""
     try:
         now = datetime.now()
-        formatted_date = now.strftime("%d-%m-%Y")
-
-        dictionary = user_read_untagged()
-        user_data = user_read(chat_id)
-
-        dictionary[str(chat_id)] = {
-            "first_name": user_data["first_name"],
-            "last_name": user_data["last_name"],
-            "username": user_data["username"],
-            "gender": user_data["gender"],
-            "type": "VIP",
-            "prefer": user_data.get("prefer", "Any"),
-            "email": user_data.get("email"),
-            "match_org": user_data.get("match_org"),
-            "date": formatted_date,
-            "created_at": user_data.get("created_at", ""),
-            "vip_upgraded": now.strftime("%Y-%m-%d %H:%M:%S")
-        }
-
-        with open(filepath, 'w') as userfile:
-            json.dump(dictionary, userfile, indent=4)
+        update_user(chat_id,
+                    type="VIP",
+                    date=now.strftime("%d-%m-%Y"),
+                    vip_upgraded=now.strftime("%Y-%m-%d %H:%M:%S"))
 
         log(f"User {chat_id} upgraded to VIP")
 
@@ -109,31 +173,23 @@ def makeVIP(chat_id):
         log(f"Error making user {chat_id} VIP: {e}")
         raise
 
-def changePrefer(chat_id, prefer):
-    """Change user's gender preference"""
+def makeFree(chat_id):
+    """Downgrade user to Free status"""
     try:
-        dictionary = user_read_untagged()
-        user_data = user_read(chat_id)
-
-        dictionary[str(chat_id)] = {
-            "first_name": user_data["first_name"],
-            "last_name": user_data["last_name"],
-            "username": user_data["username"],
-            "gender": user_data["gender"],
-            "type": user_data.get("type", "Free"),
-            "prefer": prefer,
-            "email": user_data.get("email"),
-            "match_org": user_data.get("match_org"),
-            "date": user_data.get("date", ""),
-            "created_at": user_data.get("created_at", ""),
-            "preference_updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        }
+        update_user(chat_id, type="Free")
 
-        if "vip_upgraded" in user_data:
-            dictionary[str(chat_id)]["vip_upgraded"] = user_data["vip_upgraded"]
+        log(f"User {chat_id} downgraded to Free")
 
-        with open(filepath, 'w') as userfile:
-            json.dump(dictionary, userfile, indent=4)
+    except Exception as e:
+        log(f"Error making user {chat_id} Free: {e}")
+        raise
+
+def changePrefer(chat_id, prefer):
+    """Change user's gender preference"""
+    try:
+        update_user(chat_id,
+                    prefer=prefer,
+                    preference_updated=datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
 
         log(f"User {chat_id} preference changed to {prefer}")
 
@@ -144,28 +200,9 @@ def changePrefer(chat_id, prefer):
 def changeOrgPrefer(chat_id, OrgPrefer):
     """Change user's Organisation match preference"""
     try:
-        dictionary = user_read_untagged()
-        user_data = user_read(chat_id)
-
-        dictionary[str(chat_id)] = {
-            "first_name": user_data["first_name"],
-            "last_name": user_data["last_name"],
-            "username": user_data["username"],
-            "gender": user_data["gender"],
-            "type": user_data.get("type", "Free"),
-            "prefer": user_data.get("prefer"),
-            "email": user_data.get("email"),
-            "match_org": OrgPrefer,
-            "date": user_data.get("date", ""),
-            "created_at": user_data.get("created_at", ""),
-            "preference_updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        }
-
-        if "vip_upgraded" in user_data:
-            dictionary[str(chat_id)]["vip_upgraded"] = user_data["vip_upgraded"]
-
-        with open(filepath, 'w') as userfile:
-            json.dump(dictionary, userfile, indent=4)
+        update_user(chat_id,
+                    match_org=OrgPrefer,
+                    preference_updated=datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
 
         log(f"User {chat_id} preference changed to {OrgPrefer}")
 
@@ -176,7 +213,7 @@ def changeOrgPrefer(chat_id, OrgPrefer):
 def user_exists(chat_id):
     """Check if user exists in database"""
     try:
-        users = user_read_untagged()
+        users = _load_users()
         return str(chat_id) in users
     except:
         return False
@@ -184,8 +221,10 @@ def user_exists(chat_id):
 def get_user_stats():
     """Get user statistics"""
     try:
-        users = user_read_untagged()
-        total_users = len(users)
+        users = _load_users()
+        with _lock:
+            user_list = list(users.values())
+        total_users = len(user_list)
 
         stats = {
             "total_users": total_users,
@@ -195,7 +234,7 @@ def get_user_stats():
             "free_users": 0
         }
 
-        for user_data in users.values():
+        for user_data in user_list:
             if user_data.get("gender") == "Male":
                 stats["male_users"] += 1
             elif user_data.get("gender") == "Female":
@@ -0,0 +1,129 @@
+import hmac
+import json
+import os
+import secrets
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import get_updates
+import http_client
+import root_json
+from log import log
+
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')  # Public HTTPS URL Telegram posts updates to
+WEBHOOK_HOST = os.environ.get('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/webhook')
+# Sent by Telegram in X-Telegram-Bot-Api-Secret-Token; needed unless set_webhook() makes a random one
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')
+WEBHOOK_MAX_CONNECTIONS = 40  # Concurrent deliveries Telegram may open
+MAX_UPDATE_BYTES = 1024 * 1024  # Larger bodies are rejected
+QUEUE_WAIT_SECONDS = 1  # How long a delivery waits for room in the update queue before Telegram retries it
+
+_server = None
+_thread = None
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Accepts update POSTs from Telegram and queues them for the update workers"""
+
+    def do_POST(self):
+        if self.path.split('?')[0] != WEBHOOK_PATH:
+            self._reply(404)
+            return
+        secret = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+            log(f"Rejected webhook request from {self.client_address[0]}: bad secret token")
+            self._reply(403)
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            if length <= 0 or length > MAX_UPDATE_BYTES:
+                self._reply(413 if length > 0 else 400)
+                return
+            result = json.loads(self.rfile.read(length))
+        except Exception as e:
+            log(f"Error reading webhook update: {e}")
+            self._reply(400)
+            return
+
+        # Handled later on the update workers; a full queue makes Telegram deliver it again
+        if get_updates.queue_update(result, timeout=QUEUE_WAIT_SECONDS):
+            self._reply(200)
+        else:
+            log(f"Update queue full, deferring update {result.get('update_id')}")
+            self._reply(503)
+
+    def _reply(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        """Keep the per-request access log out of the bot log"""
+
+
+def set_webhook(url=None, secret=None, max_connections=WEBHOOK_MAX_CONNECTIONS):
+    """Tell Telegram to push updates to the webhook URL, with a random secret if none is configured"""
+    global WEBHOOK_SECRET
+    if secret:
+        WEBHOOK_SECRET = secret
+    elif not WEBHOOK_SECRET:
+        WEBHOOK_SECRET = secrets.token_urlsafe(32)
+    data = {
+        "url": url or WEBHOOK_URL,
+        "secret_token": WEBHOOK_SECRET,
+        "max_connections": max_connections,
+        "allowed_updates": ["message", "edited_message", "callback_query"]
+    }
+    try:
+        response = http_client.post(f"{root_json.root_read('BASE_URL')}/setWebhook", json=data)
+        log("Webhook set: " + str(response.json()))
+        return response.status_code == 200
+    except Exception as e:
+        log(f"Error setting webhook: {e}")
+        return False
+
+
+def delete_webhook():
+    """Stop webhook delivery so getUpdates long polling works again"""
+    try:
+        response = http_client.post(f"{root_json.root_read('BASE_URL')}/deleteWebhook")
+        log("Webhook deleted: " + str(response.json()))
+        return response.status_code == 200
+    except Exception as e:
+        log(f"Error deleting webhook: {e}")
+        return False
+
+
+def _serve(server):
+    """Queue the updates accepted but not handled before the last stop, then serve deliveries"""
+    for result in get_updates.replay_spool():
+        get_updates.queue_update(result)
+    server.serve_forever()
+
+
+def start_server(host=WEBHOOK_HOST, port=WEBHOOK_PORT):
+    """Start the webhook receiver on a background thread, returns the server"""
+    global _server, _thread
+    if not WEBHOOK_SECRET:
+        # Telegram can only send a secret it was given, see set_webhook()
+        raise RuntimeError("WEBHOOK_SECRET must be set when the webhook is registered outside the bot")
+    if _server is None:
+        get_updates._load_checkpoint()
+        _server = ThreadingHTTPServer((host, port), WebhookHandler)
+        _server.daemon_threads = True
+        _thread = threading.Thread(target=_serve, args=(_server,), name="webhook-server", daemon=True)
+        _thread.start()
+        log(f"Webhook server listening on {host}:{_server.server_address[1]}{WEBHOOK_PATH}")
+    return _server
+
+
+def stop_server():
+    """Stop the webhook receiver"""
+    global _server, _thread
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
+        _thread = None